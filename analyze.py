@@ -0,0 +1,308 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from frame_source import open_frame_source, IMAGE_EXTENSIONS
+from preprocess import Preprocessor, crop_full_resolution_faces, PROCESSING_SIZE
+from tracker import Tracker
+from scheduler import FullScanScheduler
+from identity_cache import IdentityCache, face_thumbnail
+from detectors import DETECTORS
+
+# Files in a directory that are analyzed as recordings of their own. A
+# directory with none of these is taken to be the frames of one recording.
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".h264", ".frames")
+
+# Columns of the npz output, one row per track per frame
+COLUMNS = ('frame', 'time', 'track_id', 'name', 'top', 'right', 'bottom', 'left', 'live')
+
+
+def find_recordings(paths):
+    """
+    Expand the paths given on the command line into the recordings to analyze:
+    video files and frame dumps as they are, directories of them one file at a
+    time, and directories of images as one recording each.
+    """
+    recordings = []
+    for path in paths:
+        if not os.path.isdir(path):
+            recordings.append(path)
+            continue
+        videos = sorted(
+            os.path.join(path, filename) for filename in os.listdir(path)
+            if filename.lower().endswith(VIDEO_EXTENSIONS)
+        )
+        if videos:
+            recordings += videos
+        elif any(filename.lower().endswith(IMAGE_EXTENSIONS) for _, _, filenames in os.walk(path) for filename in filenames):
+            recordings.append(path)
+        else:
+            print(f"[WARNING] no recordings found in {path}")
+    return recordings
+
+
+def output_paths(recordings, output_dir, output_format):
+    """
+    The result file of each recording. The recordings' paths relative to the
+    directory they all share are kept under `output_dir`, so recordings with
+    the same name in different directories don't overwrite each other.
+    """
+    recordings = [os.path.abspath(os.path.normpath(recording)) for recording in recordings]
+    root = os.path.commonpath([os.path.dirname(recording) for recording in recordings])
+    return [
+        os.path.join(output_dir, f"{os.path.splitext(os.path.relpath(recording, root))[0]}.{output_format}")
+        for recording in recordings
+    ]
+
+
+class RecordingWriter:
+    """
+    Writes the per-frame results of one recording, either as JSON lines (one
+    line per frame) or as columns in an npz file (one row per track per
+    frame), which loads straight into numpy or pandas for tuning.
+    """
+
+    def __init__(self, path, output_format="jsonl"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.output_format = output_format
+        self.file = open(path, "w") if output_format == "jsonl" else None
+        self.columns = {column: [] for column in COLUMNS}
+
+    def write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            return
+        for track in record['tracks']:
+            self.columns['frame'].append(record['frame'])
+            self.columns['time'].append(record['time'])
+            self.columns['track_id'].append(track['id'])
+            self.columns['name'].append(track['name'])
+            for key, value in zip(('top', 'right', 'bottom', 'left'), track['box']):
+                self.columns[key].append(value)
+            self.columns['live'].append(track['live'])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            return
+        np.savez_compressed(
+            self.path,
+            frame=np.array(self.columns['frame'], dtype=np.int64),
+            time=np.array(self.columns['time'], dtype=np.float64),
+            track_id=np.array(self.columns['track_id'], dtype=np.int64),
+            name=np.array(self.columns['name'], dtype=str),
+            **{key: np.array(self.columns[key], dtype=np.float32) for key in ('top', 'right', 'bottom', 'left')},
+            live=np.array(self.columns['live'], dtype=bool))
+
+
+def identify(frame, tracker, track_ids, thumbnails, identity_cache, now, brightness_ratio):
+    """
+    Encode the faces of `track_ids` from the full resolution frame, the way
+    the recognize stage of main.py does, and cache who they are.
+    """
+    from find_faces import identify_faces, build_mosaic
+
+    locations = {track.id: track.face_location for track in tracker.tracks}
+    crops, crop_face_locations = crop_full_resolution_faces(
+        frame, [locations[track_id] for track_id in track_ids], brightness_ratio)
+    cropped = [(track_id, crop, location) for track_id, crop, location
+               in zip(track_ids, crops, crop_face_locations) if crop is not None]
+    if not cropped:
+        return {}
+    track_ids, crops, crop_face_locations = (list(column) for column in zip(*cropped))
+    mosaic, offsets = build_mosaic(crops)
+    mosaic_face_locations = [
+        (top + y, right + x, bottom + y, left + x)
+        for (top, right, bottom, left), (x, y) in zip(crop_face_locations, offsets)
+    ]
+    face_encodings, matches, _ = identify_faces(mosaic, mosaic_face_locations)
+    for track_id, face_encoding, match in zip(track_ids, face_encodings, matches):
+        identity_cache.put(track_id, face_encoding, match.name, match.distance, thumbnails[track_id], now)
+    return {track_id: match.name for track_id, match in zip(track_ids, matches)}
+
+
+def analyze_recording(recording, path, settings):
+    """
+    Run the tracking of main.py over a recording as fast as it will go, and
+    write what it found in every frame to `path`.
+
+    Frames are read one at a time from the recording, never all at once.
+    Timestamps are the frames' times in the recording rather than the wall
+    clock, and full scans are scheduled as if each took `full_scan_cost`
+    seconds, so the results are the same however fast this machine is and
+    match what the stand would have done at the recording's frame rate.
+
+    Args:
+        recording (str): Video file, .frames dump or image directory.
+        path (str): Output file.
+        settings (dict): The tuning options, see `main`.
+
+    Returns:
+        dict: Counts and timing for the recording.
+    """
+    from find_faces import locate_faces, normalize_face_locations, delta_scan
+
+    preprocessor = Preprocessor(size=PROCESSING_SIZE)
+    tracker = Tracker(redetect_threshold=settings['redetect_threshold'], redetect_interval=settings['redetect_interval'])
+    scheduler = FullScanScheduler(cpu_budget=settings['cpu_budget'], max_interval=settings['max_interval'],
+                                  motion_scale=settings['motion_scale'], failure_scale=settings['failure_scale'])
+    scheduler.scan_cost = settings['full_scan_cost']
+    identity_cache = IdentityCache()
+    writer = RecordingWriter(path, settings['format'])
+    summary = {'recording': recording, 'output': path, 'frames': 0, 'full_scans': 0, 'delta_scans': 0,
+               'delta_scans_failed': 0, 'faces_encoded': 0}
+    failed_delta_count = 0
+    started = time.time()
+
+    # The source's own size, as the preprocessor downscales anyway
+    with open_frame_source(recording, realtime=False, size=None) as frame_source:
+        for frame_index, raw_frame in enumerate(frame_source):
+            now = frame_index / frame_source.fps
+            frame = preprocessor.process(raw_frame)
+
+            to_redetect = tracker.update(frame, now)
+            if to_redetect:
+                redetected_locations, _, redetected_live, _ = delta_scan(
+                    frame,
+                    [track.face_location for track in to_redetect],
+                    [track.name for track in to_redetect],
+                    [track.live for track in to_redetect])
+                for track, face_location, is_live in zip(to_redetect, redetected_locations, redetected_live):
+                    if is_live:
+                        tracker.correct(track, face_location)
+                    else:
+                        tracker.miss(track)
+                summary['delta_scans'] += len(to_redetect)
+                summary['delta_scans_failed'] += redetected_live.count(False)
+            live = tracker.live()
+            failed_delta_count = 0 if all(live) else failed_delta_count + 1
+
+            # Full scans run inline here, where the stand runs them in the background
+            scheduler.observe(frame)
+            full_scan_reason = None
+            if scheduler.should_scan(now, len(live), sum(live), failed_delta_count):
+                full_scan_reason = scheduler.reason
+                scheduler.scan_started(now)
+                rgb_frame, pixel_face_locations, _ = locate_faces(frame, scale=1.0)
+                tracker.merge(frame, normalize_face_locations(pixel_face_locations, rgb_frame), now)
+                scheduler.scan_finished(settings['full_scan_cost'])
+                failed_delta_count = 0
+                summary['full_scans'] += 1
+
+            if settings['recognize']:
+                thumbnails = {track.id: face_thumbnail(frame, track.face_location) for track in tracker.tracks}
+                stale_ids = [track_id for track_id, thumbnail in thumbnails.items()
+                             if identity_cache.needs_refresh(track_id, thumbnail, now)]
+                names_by_id = {track_id: identity_cache.get(track_id).name
+                               for track_id in thumbnails if track_id not in stale_ids}
+                if stale_ids:
+                    names_by_id.update(identify(raw_frame, tracker, stale_ids, thumbnails, identity_cache, now,
+                                                preprocessor.brightness_ratio))
+                    summary['faces_encoded'] += len(stale_ids)
+                tracker.set_names(names_by_id)
+
+            writer.write({
+                'frame': frame_index,
+                'time': now,
+                'full_scan': full_scan_reason,
+                'redetected': [track.id for track in to_redetect],
+                'tracks': [
+                    {'id': track.id, 'name': track.name, 'box': [float(value) for value in track.face_location],
+                     'live': track.live, 'confidence': float(track.confidence)}
+                    for track in tracker.tracks
+                ],
+            })
+            summary['frames'] += 1
+
+    writer.close()
+    summary['seconds'] = time.time() - started
+    summary['fps'] = summary['frames'] / max(summary['seconds'], 1e-9)
+    return summary
+
+
+def _init_worker(full_detector, delta_detector, recognize):
+    import find_faces
+
+    find_faces.set_detectors(full=full_detector, delta=delta_detector)
+    if recognize:
+        find_faces.warm_up()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the face tracking over recordings as fast as possible")
+    parser.add_argument("recordings", nargs="+",
+                        help="video files, .frames dumps, image directories, or directories of recordings")
+    parser.add_argument("--output-dir", default="analysis", help="directory to write a result file per recording to")
+    parser.add_argument("--format", default="jsonl", choices=["jsonl", "npz"],
+                        help="JSON lines with a line per frame, or npz columns with a row per track per frame")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="recordings to analyze at once")
+    parser.add_argument("--no-recognition", action="store_true",
+                        help="only track faces, without encoding them and putting names to them")
+    parser.add_argument("--full-detector", default="mtcnn", choices=list(DETECTORS),
+                        help="face detector for full scans of the whole frame")
+    parser.add_argument("--delta-detector", default="mtcnn", choices=list(DETECTORS),
+                        help="face detector for re-finding tracked faces")
+    parser.add_argument("--cpu-budget", type=float, default=0.25, help="share of the time full scans may take up")
+    parser.add_argument("--max-interval", type=float, default=20.0, help="longest time between full scans, in seconds")
+    parser.add_argument("--motion-scale", type=float, default=0.05,
+                        help="mean frame difference that counts as a fully moving scene")
+    parser.add_argument("--failure-scale", type=int, default=10,
+                        help="consecutive frames with lost tracks that count as fully lost")
+    parser.add_argument("--full-scan-cost", type=float, default=0.5,
+                        help="seconds a full scan is taken to cost when scheduling them, as on the stand")
+    parser.add_argument("--redetect-threshold", type=float, default=0.6,
+                        help="correlation below which a track is re-detected")
+    parser.add_argument("--redetect-interval", type=int, default=15,
+                        help="frames after which a track is re-detected anyway")
+    args = parser.parse_args()
+
+    recordings = find_recordings(args.recordings)
+    if not recordings:
+        return
+    os.makedirs(args.output_dir, exist_ok=True)
+    settings = {
+        'format': args.format,
+        'recognize': not args.no_recognition,
+        'cpu_budget': args.cpu_budget,
+        'max_interval': args.max_interval,
+        'motion_scale': args.motion_scale,
+        'failure_scale': args.failure_scale,
+        'full_scan_cost': args.full_scan_cost,
+        'redetect_threshold': args.redetect_threshold,
+        'redetect_interval': args.redetect_interval,
+    }
+
+    jobs = max(1, min(args.jobs, len(recordings)))
+    print(f"[INFO] analyzing {len(recordings)} recordings, {jobs} at a time...")
+    started = time.time()
+    total_frames = 0
+    # Spawned rather than forked, as forking with TensorFlow loaded isn't safe
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(args.full_detector, args.delta_detector, settings['recognize'])) as executor:
+        futures = {
+            executor.submit(analyze_recording, recording, path, settings): recording
+            for recording, path in zip(recordings, output_paths(recordings, args.output_dir, args.format))
+        }
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as e:
+                print(f"[WARNING] {futures[future]} failed: {e!r}")
+                continue
+            total_frames += summary['frames']
+            print(f"[INFO] {summary['recording']}: {summary['frames']} frames at {summary['fps']:.1f} fps, "
+                  f"{summary['full_scans']} full scans, {summary['delta_scans']} delta scans "
+                  f"({summary['delta_scans_failed']} failed), {summary['faces_encoded']} faces encoded "
+                  f"-> '{summary['output']}'")
+
+    elapsed = time.time() - started
+    print(f"[INFO] {total_frames} frames in {elapsed:.1f} s ({total_frames / max(elapsed, 1e-9):.1f} fps overall)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from frame_source import open_frame_source
+from preprocess import preprocess_frame, Preprocessor
+from gallery_index import build_index
+from detectors import DETECTORS, create_detector
+from tracker import box_iou
+from motion_tiles import MotionTileSelector
+
+# Number of tracked faces to benchmark delta_scan and matching with
+TRACKED_FACE_COUNTS = (1, 4, 16)
+
+# Gallery sizes to benchmark the gallery indexes with
+GALLERY_SIZES = (1000, 10000, 100000)
+
+# Gallery index configurations to benchmark, by name
+GALLERY_INDEXES = {
+    'brute_force': ("brute_force", {}),
+    'ivf': ("ivf", {}),
+    'int8': ("quantized", {}),
+}
+
+# The tolerance `face_recognition.compare_faces` and FaceMatcher use
+MATCH_TOLERANCE = 0.6
+
+
+def load_frames(source, count):
+    """
+    Load up to `count` canned frames from a frame source into memory, already
+    preprocessed the way the main loop would.
+    """
+    raw_frames = []
+    with open_frame_source(source, realtime=False) as frame_source:
+        for frame in frame_source:
+            raw_frames.append(np.array(frame))
+            if len(raw_frames) >= count:
+                break
+    if not raw_frames:
+        raise IOError(f"No frames in {source}")
+    return raw_frames, [preprocess_frame(frame) for frame in raw_frames]
+
+
+def summarize(samples):
+    """
+    Latency percentiles (in milliseconds) and throughput for a list of
+    durations in seconds.
+    """
+    samples_ms = np.array(samples) * 1000
+    return {
+        'runs': len(samples),
+        'mean_ms': float(np.mean(samples_ms)),
+        'p50_ms': float(np.percentile(samples_ms, 50)),
+        'p95_ms': float(np.percentile(samples_ms, 95)),
+        'p99_ms': float(np.percentile(samples_ms, 99)),
+        'fps': float(1000 / np.mean(samples_ms)),
+    }
+
+
+def time_runs(func, inputs, runs, warmup):
+    """
+    Call `func` on the inputs in turn, `warmup` times untimed and then `runs`
+    times timed, and summarize the timings.
+    """
+    for i in range(warmup):
+        func(inputs[i % len(inputs)])
+    samples = []
+    for i in range(runs):
+        start = time.perf_counter()
+        func(inputs[i % len(inputs)])
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def make_tracked_faces(frame, count):
+    """
+    Build `count` normalized face locations to feed delta_scan with: the faces
+    full_scan finds in the frame, topped up with boxes on a grid.
+    """
+    import find_faces
+
+    face_locations, _, _, _ = find_faces.full_scan(frame)
+    face_locations = list(face_locations[:count])
+
+    grid_size = int(np.ceil(np.sqrt(count)))
+    cell = 1.0 / grid_size
+    box = cell * 0.5
+    for i in range(count - len(face_locations)):
+        row, column = divmod(i, grid_size)
+        top = row * cell + (cell - box) / 2
+        left = column * cell + (cell - box) / 2
+        face_locations.append((top, left + box, top + box, left))
+    return face_locations
+
+
+def make_face_encodings(count, seed=0):
+    """
+    Random encodings with the same shape and rough scale as dlib's.
+    """
+    rng = np.random.default_rng(seed)
+    return list(rng.normal(0, 0.1, size=(count, 128)))
+
+
+def make_gallery(size, query_count, samples_per_person=5, seed=0):
+    """
+    A synthetic gallery of `size` encodings, clustered around one center per
+    person like real enrollments, and held-out queries: fresh samples of
+    enrolled people, and for a quarter of them, of people who aren't enrolled.
+    Gallery row `i` belongs to person `i % people`.
+    """
+    rng = np.random.default_rng(seed)
+    people = max(1, size // samples_per_person)
+    centers = rng.normal(0, 0.1, size=(people, 128)).astype(np.float32)
+    gallery = centers[np.arange(size) % people] + rng.normal(0, 0.03, size=(size, 128)).astype(np.float32)
+    strangers = rng.normal(0, 0.1, size=(query_count // 4, 128)).astype(np.float32)
+    query_centers = np.concatenate([centers[rng.integers(0, people, query_count - len(strangers))], strangers])
+    queries = query_centers + rng.normal(0, 0.03, size=(query_count, 128)).astype(np.float32)
+    return gallery, queries, people
+
+
+def match_decisions(distances, indices, people):
+    """
+    Who each query would be recognized as at MATCH_TOLERANCE, -1 for unknown.
+    """
+    return np.where(distances[:, 0] <= MATCH_TOLERANCE, indices[:, 0] % people, -1)
+
+
+def run_gallery_benchmarks(sizes, runs, warmup, query_count=200):
+    """
+    Single-face search latency, recall@1 (agreement with the exact nearest
+    neighbour) and agreement with the exact match decision at MATCH_TOLERANCE,
+    for each gallery index configuration and size.
+    """
+    results = {}
+    for size in sizes:
+        gallery, queries, people = make_gallery(size, query_count)
+        exact_distances, exact = build_index(gallery, "brute_force").search(queries, 1)
+        exact_decisions = match_decisions(exact_distances, exact, people)
+        for name, (kind, options) in GALLERY_INDEXES.items():
+            print(f"[INFO] benchmarking {name} index with {size} encodings...")
+            build_start = time.perf_counter()
+            index = build_index(gallery, kind, **options)
+            build_time = time.perf_counter() - build_start
+
+            distances, found = index.search(queries, 1)
+            result = time_runs(lambda query: index.search(query[None, :], 1), queries, runs, warmup)
+            result['recall'] = float(np.mean(found[:, 0] == exact[:, 0]))
+            result['decision_agreement'] = float(np.mean(match_decisions(distances, found, people) == exact_decisions))
+            result['build_s'] = build_time
+            results[f'gallery[{name},{size}]'] = result
+    return results
+
+
+def run_detector_benchmarks(frames, names, reference, runs, warmup):
+    """
+    Latency and recall of each detector backend on the half-resolution RGB
+    frames that full_scan detects on. There are no labels for the replay
+    frames, so recall is measured against the `reference` detector: the
+    fraction of its faces that the backend finds with an IoU of at least 0.5.
+    """
+    import cv2
+
+    rgb_frames = [cv2.cvtColor(cv2.resize(frame, (0, 0), fx=0.5, fy=0.5), cv2.COLOR_BGRA2RGB) for frame in frames]
+    detectors = {}
+    for name in names:
+        try:
+            detectors[name] = create_detector(name)
+        except Exception as e:
+            print(f"[WARNING] skipping {name} detector: {e!r}")
+    if reference not in detectors:
+        detectors[reference] = create_detector(reference)
+    expected = [detectors[reference].detect(frame) for frame in rgb_frames]
+
+    results = {}
+    for name in names:
+        if name not in detectors:
+            continue
+        print(f"[INFO] benchmarking {name} detector...")
+        detector = detectors[name]
+        result = time_runs(detector.detect, rgb_frames, runs, warmup)
+        found = 0
+        total = 0
+        for frame, expected_faces in zip(rgb_frames, expected):
+            faces = detector.detect(frame)
+            total += len(expected_faces)
+            found += sum(1 for face in expected_faces if any(box_iou(face, other) >= 0.5 for other in faces))
+        result['recall'] = found / total if total else 1.0
+        results[f'detector[{name}]'] = result
+    return results
+
+
+def run_benchmarks(raw_frames, frames, runs, warmup):
+    # Imported here so the gallery benchmarks run without the detector and its models
+    import cv2
+    import find_faces
+
+    results = {}
+
+    print("[INFO] benchmarking preprocessing...")
+    results['preprocess'] = time_runs(preprocess_frame, raw_frames, runs, warmup)
+    results['preprocess_fused'] = time_runs(Preprocessor().process, raw_frames, runs, warmup)
+
+    print("[INFO] benchmarking full_scan...")
+    results['full_scan'] = time_runs(find_faces.full_scan, frames, runs, warmup)
+
+    # Detection alone at the resolution the pipeline's full scans run at, over
+    # the whole frame and over the tiles that changed since the previous frame
+    print("[INFO] benchmarking whole frame and tiled full scan detection...")
+    half_frames = [cv2.resize(frame, (0, 0), fx=0.5, fy=0.5) for frame in frames]
+    results['locate_faces'] = time_runs(lambda frame: find_faces.locate_faces(frame, scale=1.0), half_frames, runs, warmup)
+    tile_selector = MotionTileSelector()
+    tile_selector.select(half_frames[-1])
+
+    def tiled_scan(frame):
+        regions = [tile_selector.tile_box(tile) for tile in tile_selector.select(frame)]
+        return find_faces.locate_faces_in_regions(frame, regions)
+    results['locate_faces_tiled'] = time_runs(tiled_scan, half_frames, runs, warmup)
+
+    for count in TRACKED_FACE_COUNTS:
+        print(f"[INFO] benchmarking delta_scan with {count} tracked faces...")
+        tracked = [(frame, make_tracked_faces(frame, count)) for frame in frames]
+        results[f'delta_scan[{count}]'] = time_runs(
+            lambda item: find_faces.delta_scan(item[0], item[1], ["Unknown"] * len(item[1]), [True] * len(item[1])),
+            tracked, runs, warmup)
+
+    for count in TRACKED_FACE_COUNTS:
+        print(f"[INFO] benchmarking matching with {count} faces...")
+        results[f'match[{count}]'] = time_runs(find_faces.match_faces, [make_face_encodings(count)], runs, warmup)
+
+    return results
+
+
+def run_worker_benchmarks(frames, worker_counts, runs, warmup, tracked_face_count=4):
+    """
+    How full scans, delta scans and encoding scale with the number of worker
+    processes. Frames are halved like the pipeline's preprocessing does.
+    """
+    import cv2
+    from worker_pool import WorkerPool
+
+    half_frames = [cv2.resize(frame, (0, 0), fx=0.5, fy=0.5) for frame in frames]
+    tracked = [(frame, make_tracked_faces(frame, tracked_face_count)) for frame in half_frames]
+    results = {}
+    for count in worker_counts:
+        print(f"[INFO] benchmarking with {count} worker processes...")
+        with WorkerPool(count) as pool:
+            results[f'workers[{count}].full_scan'] = time_runs(pool.locate_faces, half_frames, runs, warmup)
+            results[f'workers[{count}].delta_scan[{tracked_face_count}]'] = time_runs(
+                lambda item: pool.delta_scan(item[0], item[1], ["Unknown"] * len(item[1]), [True] * len(item[1])),
+                tracked, runs, warmup)
+
+            def encode(item):
+                frame, face_locations = item
+                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2RGB)
+                height, width = rgb_frame.shape[:2]
+                pixel_face_locations = [
+                    (int(top * height), int(right * width), int(bottom * height), int(left * width))
+                    for (top, right, bottom, left) in face_locations
+                ]
+                return pool.identify_faces(rgb_frame, pixel_face_locations)
+            results[f'workers[{count}].encode[{tracked_face_count}]'] = time_runs(encode, tracked, runs, warmup)
+    return results
+
+
+def compare(results, baseline, metric, threshold):
+    """
+    Print each benchmark next to its baseline and return the names of those
+    that got slower by more than `threshold` (a fraction, e.g. 0.1 for 10%).
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:>28}: {result[metric]:9.2f} ms (no baseline)")
+            continue
+        before = baseline[name][metric]
+        after = result[metric]
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:>28}: {before:9.2f} ms -> {after:9.2f} ms ({change * 100:+.1f}%){flag}")
+    return regressions
+
+
+def print_results(results):
+    for name, result in results.items():
+        recall = f", recall {result['recall'] * 100:5.1f}%" if 'recall' in result else ""
+        if 'decision_agreement' in result:
+            recall += f", decisions {result['decision_agreement'] * 100:5.1f}%"
+        print(f"{name:>28}: p50 {result['p50_ms']:8.2f} ms, p95 {result['p95_ms']:8.2f} ms, "
+              f"p99 {result['p99_ms']:8.2f} ms, {result['fps']:8.1f} fps{recall}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the face tracking hot paths on canned frames")
+    parser.add_argument("--source", default="dataset",
+                        help="video file, image directory or .frames dump to take the frames from")
+    parser.add_argument("--frames", type=int, default=10, help="number of frames to load from the source")
+    parser.add_argument("--runs", type=int, default=50, help="timed runs per benchmark")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed runs per benchmark")
+    parser.add_argument("--save", metavar="FILE", help="write the results to a JSON baseline file")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results against a JSON baseline file")
+    parser.add_argument("--metric", default="p50_ms", choices=["mean_ms", "p50_ms", "p95_ms", "p99_ms"],
+                        help="metric to compare against the baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="flag benchmarks that are slower than the baseline by more than this fraction")
+    parser.add_argument("--gallery", action="store_true",
+                        help="benchmark the gallery indexes on synthetic galleries instead of the frame pipeline")
+    parser.add_argument("--detectors", metavar="NAMES",
+                        help=f"compare detector backends ({','.join(DETECTORS)}) instead of the frame pipeline")
+    parser.add_argument("--reference-detector", default="mtcnn",
+                        help="detector whose faces count as ground truth for --detectors recall")
+    parser.add_argument("--workers", metavar="COUNTS",
+                        help="comma separated worker process counts to benchmark the worker pool with, e.g. 1,2,3,4")
+    parser.add_argument("--gallery-sizes", default=",".join(str(size) for size in GALLERY_SIZES),
+                        help="comma separated gallery sizes for --gallery")
+    args = parser.parse_args()
+
+    if args.gallery:
+        sizes = [int(size) for size in args.gallery_sizes.split(",")]
+        results = run_gallery_benchmarks(sizes, args.runs, args.warmup)
+    elif args.workers:
+        _, frames = load_frames(args.source, args.frames)
+        counts = [int(count) for count in args.workers.split(",")]
+        results = run_worker_benchmarks(frames, counts, args.runs, args.warmup)
+    elif args.detectors:
+        _, frames = load_frames(args.source, args.frames)
+        results = run_detector_benchmarks(frames, args.detectors.split(","), args.reference_detector, args.runs, args.warmup)
+    else:
+        raw_frames, frames = load_frames(args.source, args.frames)
+        results = run_benchmarks(raw_frames, frames, args.runs, args.warmup)
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({'source': args.source, 'created': time.time(), 'results': results}, f, indent=2)
+        print(f"[INFO] baseline saved to '{args.save}'")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.metric, args.threshold)
+        if regressions:
+            print(f"[WARNING] {len(regressions)} regression(s) over {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
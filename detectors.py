@@ -0,0 +1,146 @@
+import threading
+import cv2
+import numpy as np
+
+
+class FaceDetector:
+    """
+    Base class for the face detector backends. `detect` takes an RGB image and
+    returns a (top, right, bottom, left) box in pixels for each face found.
+
+    Backends implement `_detect`. Full scans run on their own thread and
+    usually share a detector with delta scans, and none of the backends can be
+    run from two threads at once, so `detect` runs one call at a time.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def detect(self, rgb_image):
+        with self.lock:
+            return self._detect(rgb_image)
+
+    def _detect(self, rgb_image):
+        raise NotImplementedError
+
+
+class MTCNNDetector(FaceDetector):
+    """
+    The MTCNN neural network detector: the most accurate, and the slowest.
+    """
+
+    name = "mtcnn"
+
+    def __init__(self):
+        super().__init__()
+        # Imported here because it pulls in TensorFlow
+        from mtcnn import MTCNN
+
+        self.detector = MTCNN()
+
+    def _detect(self, rgb_image):
+        detections = self.detector.detect_faces(rgb_image)
+        face_locations = []
+        for detection in detections:
+            x, y, width, height = detection['box']
+            face_locations.append((y, x + width, y + height, x))
+        return face_locations
+
+
+class HOGDetector(FaceDetector):
+    """
+    dlib's HOG detector, as used by `face_recognition.face_locations`. Only
+    finds roughly frontal faces of about 80 pixels or more.
+    """
+
+    name = "hog"
+
+    def __init__(self, upsample=0):
+        super().__init__()
+        import face_recognition
+
+        self.face_recognition = face_recognition
+        self.upsample = upsample
+
+    def _detect(self, rgb_image):
+        return self.face_recognition.face_locations(rgb_image, number_of_times_to_upsample=self.upsample, model="hog")
+
+
+class CascadeDetector(FaceDetector):
+    """
+    An OpenCV Haar or LBP cascade. Very fast but prone to false positives.
+    Defaults to the frontal face Haar cascade that ships with OpenCV; pass
+    `cascade_path` for another cascade such as `lbpcascade_frontalface.xml`.
+    """
+
+    name = "cascade"
+
+    def __init__(self, cascade_path=None, scale_factor=1.1, min_neighbors=5, min_size=(20, 20)):
+        super().__init__()
+        if cascade_path is None:
+            cascade_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+        self.classifier = cv2.CascadeClassifier(cascade_path)
+        if self.classifier.empty():
+            raise IOError(f"Could not load cascade {cascade_path}")
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+
+    def _detect(self, rgb_image):
+        gray = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY)
+        faces = self.classifier.detectMultiScale(
+            gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors, minSize=self.min_size)
+        return [(int(y), int(x + width), int(y + height), int(x)) for (x, y, width, height) in faces]
+
+
+class DNNDetector(FaceDetector):
+    """
+    OpenCV's ResNet-10 SSD face detector run through `cv2.dnn`. Much faster
+    than MTCNN on the Pi and nearly as accurate. The model files aren't
+    shipped with OpenCV; download them into `models/`.
+    """
+
+    name = "dnn"
+
+    def __init__(self, prototxt_path="models/deploy.prototxt",
+                 model_path="models/res10_300x300_ssd_iter_140000.caffemodel",
+                 confidence_threshold=0.5, input_size=(300, 300)):
+        super().__init__()
+        self.net = cv2.dnn.readNetFromCaffe(prototxt_path, model_path)
+        self.confidence_threshold = confidence_threshold
+        self.input_size = input_size
+
+    def _detect(self, rgb_image):
+        height, width = rgb_image.shape[:2]
+        # The model was trained on BGR images with these channel means removed
+        bgr_image = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR)
+        blob = cv2.dnn.blobFromImage(bgr_image, 1.0, self.input_size, (104.0, 177.0, 123.0), swapRB=False)
+        self.net.setInput(blob)
+        detections = self.net.forward()[0, 0]
+
+        face_locations = []
+        for detection in detections:
+            if detection[2] < self.confidence_threshold:
+                continue
+            left, top, right, bottom = (detection[3:7] * np.array([width, height, width, height])).astype(int)
+            face_locations.append((max(0, top), min(width, right), min(height, bottom), max(0, left)))
+        return face_locations
+
+
+DETECTORS = {
+    MTCNNDetector.name: MTCNNDetector,
+    HOGDetector.name: HOGDetector,
+    CascadeDetector.name: CascadeDetector,
+    DNNDetector.name: DNNDetector,
+}
+
+
+def create_detector(name, **options):
+    """
+    Create a face detector backend by name: "mtcnn", "hog", "cascade" or "dnn".
+    """
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown face detector '{name}', expected one of {', '.join(DETECTORS)}")
+    return DETECTORS[name](**options)
@@ -0,0 +1,138 @@
+import argparse
+import hashlib
+import json
+import os
+import struct
+from collections import namedtuple
+import numpy as np
+
+# Gallery file layout (all little-endian):
+#
+#   header   magic, format version, model type, encoding count, dimensions,
+#            the offsets of the sections below, and a fingerprint of the
+#            encodings (see `gallery_fingerprint`)
+#   matrix   count x dimensions float32 encodings, 64-byte aligned so it can
+#            be memory-mapped and used in place
+#   names    UTF-8 JSON list with the name for each row of the matrix
+GALLERY_MAGIC = b"FTSG"
+GALLERY_VERSION = 2
+GALLERY_HEADER = struct.Struct("<4sI64sQIQQQ16s")
+# Version 1 headers have no fingerprint
+GALLERY_HEADER_V1 = struct.Struct("<4sI64sQIQQQ")
+MATRIX_ALIGNMENT = 64
+
+# The model `face_recognition.face_encodings` produces encodings with
+DEFAULT_MODEL = "dlib_face_recognition_resnet_model_v1"
+
+GALLERY_PATH = "encodings.gallery"
+
+Gallery = namedtuple("Gallery", ["encodings", "names", "model", "version", "fingerprint"])
+
+
+def gallery_fingerprint(encodings, chunk_size=65536):
+    """
+    A hash of the float32 encodings. It is worked out once when the gallery is
+    saved and stored in its header, and gallery indexes store the fingerprint
+    of the gallery they were built for, so an index built for another gallery
+    (even one of the same size) is never used with this one.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(np.shape(encodings)).encode("ascii"))
+    # Chunked so a memory-mapped gallery isn't copied whole
+    for i in range(0, len(encodings), chunk_size):
+        digest.update(np.ascontiguousarray(encodings[i:i + chunk_size], dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def save_gallery(path, encodings, names, model=DEFAULT_MODEL):
+    """
+    Write encodings and their names to a gallery file. The file is written
+    next to `path` and moved into place so readers never see a partial file.
+
+    Returns:
+        str: The fingerprint of the encodings, as stored in the file.
+    """
+    names = list(names)
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(len(names), -1) if names else np.zeros((0, 128), np.float32)
+    count, dimensions = encodings.shape
+    model_bytes = model.encode("utf-8")
+    if len(model_bytes) > 64:
+        raise ValueError(f"Model name '{model}' is longer than 64 bytes")
+
+    matrix_offset = -(-GALLERY_HEADER.size // MATRIX_ALIGNMENT) * MATRIX_ALIGNMENT
+    names_offset = matrix_offset + encodings.nbytes
+    names_bytes = json.dumps(names).encode("utf-8")
+    fingerprint = gallery_fingerprint(encodings)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(GALLERY_HEADER.pack(
+            GALLERY_MAGIC, GALLERY_VERSION, model_bytes, count, dimensions,
+            matrix_offset, names_offset, len(names_bytes), bytes.fromhex(fingerprint)))
+        f.write(b"\0" * (matrix_offset - GALLERY_HEADER.size))
+        f.write(np.ascontiguousarray(encodings).data)
+        f.write(names_bytes)
+    os.replace(tmp_path, path)
+    return fingerprint
+
+
+def load_gallery(path=GALLERY_PATH):
+    """
+    Open a gallery file. The encodings are memory-mapped read-only rather than
+    read, so loading takes the same time whatever the size of the gallery.
+
+    Returns:
+        Gallery: The encodings (a count x dimensions float32 array), the names,
+            the model type, the format version and the fingerprint of the
+            encodings (None for version 1 files, which don't store one).
+    """
+    with open(path, "rb") as f:
+        header = f.read(GALLERY_HEADER.size)
+        if len(header) < GALLERY_HEADER_V1.size or header[:4] != GALLERY_MAGIC:
+            raise IOError(f"{path} is not a gallery file")
+        version = struct.unpack_from("<I", header, 4)[0]
+        if version == 1:
+            (_, _, model_bytes, count, dimensions,
+             matrix_offset, names_offset, names_length) = GALLERY_HEADER_V1.unpack_from(header)
+            fingerprint = None
+        elif version == GALLERY_VERSION and len(header) == GALLERY_HEADER.size:
+            (_, _, model_bytes, count, dimensions,
+             matrix_offset, names_offset, names_length, fingerprint_bytes) = GALLERY_HEADER.unpack(header)
+            fingerprint = fingerprint_bytes.hex()
+        else:
+            raise IOError(f"{path} has gallery format version {version}, expected {GALLERY_VERSION}")
+        f.seek(names_offset)
+        names = json.loads(f.read(names_length).decode("utf-8"))
+
+    if len(names) != count:
+        raise IOError(f"{path} is corrupt: {count} encodings but {len(names)} names")
+    if count == 0:
+        encodings = np.zeros((0, dimensions), dtype=np.float32)
+    else:
+        encodings = np.memmap(path, dtype=np.float32, mode='r', offset=matrix_offset, shape=(count, dimensions))
+    model = model_bytes.rstrip(b"\0").decode("utf-8")
+    return Gallery(encodings, names, model, version, fingerprint)
+
+
+def convert_pickle(pickle_path, gallery_path=GALLERY_PATH):
+    """
+    Import an `encodings.pickle` written by older versions of model_training.py.
+    Only run this on files you trust: unpickling can execute arbitrary code.
+    """
+    import pickle
+
+    with open(pickle_path, "rb") as f:
+        data = pickle.loads(f.read())
+    save_gallery(gallery_path, data["encodings"], data["names"])
+    return len(data["names"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert an encodings.pickle to the gallery format")
+    parser.add_argument("pickle_path", nargs="?", default="encodings.pickle")
+    parser.add_argument("gallery_path", nargs="?", default=GALLERY_PATH)
+    args = parser.parse_args()
+
+    print(f"[INFO] converting '{args.pickle_path}'...")
+    count = convert_pickle(args.pickle_path, args.gallery_path)
+    print(f"[INFO] {count} encodings saved to '{args.gallery_path}'")
@@ -0,0 +1,61 @@
+from collections import namedtuple
+import numpy as np
+from gallery_index import BruteForceIndex
+
+# The best match for one face: `name` is "Unknown" when even the closest known
+# face is further away than the tolerance. `candidates` lists the closest
+# (name, distance) pairs, nearest first.
+Match = namedtuple("Match", ["name", "distance", "candidates"])
+
+
+class FaceMatcher:
+    """
+    Matches face encodings against the known faces in one batched distance
+    computation. The known encodings are held in a contiguous float32 matrix
+    so nothing is rebuilt per call.
+
+    Args:
+        encodings (list): The known face encodings.
+        names (list): The name for each of the known encodings.
+        tolerance (float): How far apart two encodings can be and still match.
+            0.6 is the default of `face_recognition.compare_faces`.
+        index: The gallery index to search with (see `gallery_index`). Defaults
+            to an exact brute-force search.
+    """
+
+    def __init__(self, encodings, names, tolerance=0.6, dimensions=128, index=None):
+        self.names = list(names)
+        self.tolerance = tolerance
+        # A float32 matrix (such as a memory-mapped gallery) is used as is, without a copy
+        self.encodings = np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(len(self.names), dimensions))
+        self.index = index if index is not None else BruteForceIndex().build(self.encodings)
+
+    def __len__(self):
+        return len(self.names)
+
+    def match(self, face_encodings, k=1):
+        """
+        Find the best match and the `k` nearest candidates for each face encoding.
+
+        Returns:
+            list: A `Match` for each face encoding.
+        """
+        if len(face_encodings) == 0:
+            return []
+        if len(self.names) == 0:
+            return [Match("Unknown", float('inf'), []) for _ in face_encodings]
+
+        faces = np.asarray(face_encodings, dtype=np.float32).reshape(-1, self.encodings.shape[1])
+        distances, indices = self.index.search(faces, k)
+
+        matches = []
+        for face_distances, face_indices in zip(distances, indices):
+            # Approximate indexes mark missing candidates with -1
+            candidates = [(self.names[i], float(d)) for d, i in zip(face_distances, face_indices) if i >= 0]
+            if not candidates:
+                matches.append(Match("Unknown", float('inf'), []))
+                continue
+            best_name, best_distance = candidates[0]
+            name = best_name if best_distance <= self.tolerance else "Unknown"
+            matches.append(Match(name, best_distance, candidates))
+        return matches
@@ -1,21 +1,24 @@
 import face_recognition
 import cv2
 import numpy as np
-from picamera2 import Picamera2
 import time
-import pickle
+import os
+import sys
+
+# Allow importing the shared modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from frame_source import open_frame_source
+from encodings_store import load_gallery
 
 # Load pre-trained face encodings
 print("[INFO] loading encodings...")
-with open("encodings.pickle", "rb") as f:
-    data = pickle.loads(f.read())
-known_face_encodings = data["encodings"]
-known_face_names = data["names"]
+gallery = load_gallery()
+known_face_encodings = gallery.encodings
+known_face_names = gallery.names
 
-# Initialize the camera
-picam2 = Picamera2()
-picam2.configure(picam2.create_preview_configuration(main={"format": 'XRGB8888', "size": (1920, 1080)}))
-picam2.start()
+# Initialize the camera, or replay the recording given on the command line
+frame_source = open_frame_source(sys.argv[1] if len(sys.argv) > 1 else "picamera", size=(1920, 1080))
+frame_source.start()
 
 # Initialize our variables
 cv_scaler = 4 # this has to be a whole number
@@ -86,7 +89,9 @@ def calculate_fps():
 
 while True:
     # Capture a frame from camera
-    frame = picam2.capture_array()
+    frame = frame_source.read()
+    if frame is None:
+        break
 
     # Process the frame with the function
     processed_frame = process_frame(frame)
@@ -113,4 +118,4 @@ while True:
 
 # By breaking the loop we run this code here which closes everything
 cv2.destroyAllWindows()
-picam2.stop()
\ No newline at end of file
+frame_source.stop()
\ No newline at end of file
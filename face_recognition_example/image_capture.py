@@ -1,9 +1,13 @@
 import cv2
 import os
 from datetime import datetime
-from picamera2 import Picamera2
+import sys
 import time
 
+# Allow importing the shared modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from frame_source import PicameraSource
+
 # Change this to the name of the person you're photographing
 PERSON_NAME = "jaryd"  
 
@@ -21,9 +25,8 @@ def capture_photos(name):
     folder = create_folder(name)
     
     # Initialize the camera
-    picam2 = Picamera2()
-    picam2.configure(picam2.create_preview_configuration(main={"format": 'XRGB8888', "size": (640, 480)}))
-    picam2.start()
+    frame_source = PicameraSource(size=(640, 480))
+    frame_source.start()
 
     # Allow camera to warm up
     time.sleep(2)
@@ -34,7 +37,7 @@ def capture_photos(name):
     
     while True:
         # Capture frame from Pi Camera
-        frame = picam2.capture_array()
+        frame = frame_source.read()
         
         # Display the frame
         cv2.imshow('Capture', frame)
@@ -54,7 +57,7 @@ def capture_photos(name):
     
     # Clean up
     cv2.destroyAllWindows()
-    picam2.stop()
+    frame_source.stop()
     print(f"Photo capture completed. {photo_count} photos saved for {name}.")
 
 if __name__ == "__main__":
@@ -1,31 +1,151 @@
 import os
 from imutils import paths
 import face_recognition
-import pickle
 import cv2
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-print("[INFO] start processing faces...")
-imagePaths = list(paths.list_images("dataset"))
-knownEncodings = []
-knownNames = []
+# Allow importing the shared modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gallery_index import INDEX_TYPES, build_index, index_path, saved_index_settings
+from encodings_store import GALLERY_PATH, load_gallery, save_gallery
 
-for (i, imagePath) in enumerate(imagePaths):
-    print(f"[INFO] processing image {i + 1}/{len(imagePaths)}")
-    name = imagePath.split(os.path.sep)[-2]
-    
+# Galleries at least this big get an approximate index, smaller ones are
+# searched exhaustively
+APPROXIMATE_INDEX_MIN_SIZE = 1000
+
+# Records which images the gallery was built from, so that only new or
+# changed images need encoding on the next run. Entries are in gallery order
+# and each owns `count` consecutive rows of the gallery.
+MANIFEST_PATH = "encodings.manifest.json"
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def encode_image(imagePath):
+    """
+    Detect and encode the faces in one image. Runs in a worker process.
+    Images that can't be read have no faces, so they don't stop the training.
+    """
     image = cv2.imread(imagePath)
+    if image is None:
+        print(f"[WARNING] could not read {imagePath}, skipping it")
+        return []
     rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
+
     boxes = face_recognition.face_locations(rgb, model="hog")
     encodings = face_recognition.face_encodings(rgb, boxes)
-    
-    for encoding in encodings:
-        knownEncodings.append(encoding)
-        knownNames.append(name)
+    return [np.asarray(encoding, dtype=np.float32) for encoding in encodings]
+
+def load_previous_training():
+    """
+    The manifest and the gallery of the last run, or empty ones if there is no
+    usable previous run.
+    """
+    if not (os.path.exists(MANIFEST_PATH) and os.path.exists(GALLERY_PATH)):
+        return [], np.zeros((0, 128), dtype=np.float32)
+    with open(MANIFEST_PATH) as f:
+        manifest = json.load(f)
+    gallery = load_gallery(GALLERY_PATH)
+    if sum(entry["count"] for entry in manifest) != len(gallery.names):
+        print("[WARNING] manifest does not match the gallery, retraining everything")
+        return [], np.zeros((0, 128), dtype=np.float32)
+    return manifest, np.array(gallery.encodings)
+
+def train(dataset="dataset", full=False, workers=None, index_kind=None):
+    print("[INFO] start processing faces...")
+    imagePaths = sorted(paths.list_images(dataset))
+
+    previous_manifest, previous_encodings = ([], None) if full else load_previous_training()
+
+    # Find each previous image's rows in the old gallery
+    previous = {}
+    row = 0
+    for entry in previous_manifest:
+        previous[entry["path"]] = (entry, previous_encodings[row:row + entry["count"]])
+        row += entry["count"]
+
+    # Decide which images can keep their encodings. The mtime and size are
+    # checked first so unchanged images don't even have to be read.
+    manifest = []
+    kept = {}
+    to_encode = []
+    for imagePath in imagePaths:
+        stat = os.stat(imagePath)
+        entry = {"path": imagePath, "name": imagePath.split(os.path.sep)[-2], "mtime": stat.st_mtime, "size": stat.st_size}
+        old = previous.get(imagePath)
+        if old is not None:
+            if (old[0]["mtime"], old[0]["size"]) == (entry["mtime"], entry["size"]):
+                entry["hash"] = old[0]["hash"]
+            else:
+                entry["hash"] = file_hash(imagePath)
+            if entry["hash"] == old[0]["hash"]:
+                kept[imagePath] = old[1]
+        else:
+            entry["hash"] = file_hash(imagePath)
+        if imagePath not in kept:
+            to_encode.append(imagePath)
+        manifest.append(entry)
+
+    removed = len(set(previous) - set(imagePaths))
+    print(f"[INFO] {len(kept)} images unchanged, {len(to_encode)} to encode, {removed} removed")
+
+    # Detection and encoding are independent per image, so spread them over all cores
+    encoded = {}
+    if to_encode:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for i, (imagePath, encodings) in enumerate(zip(to_encode, executor.map(encode_image, to_encode))):
+                print(f"[INFO] processed image {i + 1}/{len(to_encode)}")
+                encoded[imagePath] = encodings
+
+    knownEncodings = []
+    knownNames = []
+    for entry in manifest:
+        encodings = kept[entry["path"]] if entry["path"] in kept else encoded[entry["path"]]
+        entry["count"] = len(encodings)
+        for encoding in encodings:
+            knownEncodings.append(encoding)
+            knownNames.append(entry["name"])
+
+    print("[INFO] serializing encodings...")
+    fingerprint = save_gallery(GALLERY_PATH, knownEncodings, knownNames)
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    if knownEncodings:
+        saved = saved_index_settings(index_path(GALLERY_PATH))
+        if index_kind is not None:
+            kind, options = index_kind, {}
+        elif saved is not None:
+            # Keep the kind of index an earlier run was asked for, with its options
+            kind, options = saved
+        else:
+            kind = "ivf" if len(knownEncodings) >= APPROXIMATE_INDEX_MIN_SIZE else "brute_force"
+            options = {}
+        print(f"[INFO] building {kind} gallery index...")
+        index = build_index(np.array(knownEncodings, dtype=np.float32), kind, fingerprint, **options)
+        index.save(index_path(GALLERY_PATH))
+    elif os.path.exists(index_path(GALLERY_PATH)):
+        # Nothing left to index, and the old index would describe faces that are gone
+        os.remove(index_path(GALLERY_PATH))
+
+    print(f"[INFO] Training complete. Encodings saved to '{GALLERY_PATH}'")
 
-print("[INFO] serializing encodings...")
-data = {"encodings": knownEncodings, "names": knownNames}
-with open("encodings.pickle", "wb") as f:
-    f.write(pickle.dumps(data))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode the faces in the dataset folder")
+    parser.add_argument("--full", action="store_true", help="re-encode every image instead of only new or changed ones")
+    parser.add_argument("--workers", type=int, help="number of worker processes (defaults to the number of cores)")
+    parser.add_argument("--index", choices=list(INDEX_TYPES),
+                        help="gallery index to build (defaults to the kind of the existing index, or else to ivf "
+                             "for large galleries and brute_force otherwise)")
+    args = parser.parse_args()
 
-print("[INFO] Training complete. Encodings saved to 'encodings.pickle'")
\ No newline at end of file
+    train(full=args.full, workers=args.workers, index_kind=args.index)
@@ -1,96 +1,387 @@
+import threading
 import time
 import cv2
-import face_recognition
-import pickle
 import numpy as np
-from mtcnn import MTCNN
+from face_matcher import FaceMatcher
+from detectors import create_detector
+from gallery_index import index_path, load_index
+from encodings_store import GALLERY_PATH, load_gallery
+from metrics import metrics
 
-detector = MTCNN()
+# The detectors, the face encoder and the known faces are loaded on first use
+# rather than on import, because TensorFlow, dlib and the gallery take seconds
+# to load and most tools only need some of them. `warm_up` loads them all
+# ahead of time.
+_models_lock = threading.Lock()
+# The detector used to find faces in the whole frame, and the one used to
+# re-find tracked faces in their cropped regions. See `set_detectors`.
+_detector_names = {'full': "mtcnn", 'delta': "mtcnn"}
+_detectors = {}
+_matcher = None
+_face_recognition = None
 
-# Load pre-trained face encodings
-print("[INFO] loading encodings...")
-with open("encodings.pickle", "rb") as f:
-    data = pickle.loads(f.read())
-known_face_encodings = data["encodings"]
-known_face_names = data["names"]
+# A tiled full scan is only worth it when the mosaic of its tiles is at most
+# this fraction of the frame. The detector's cost doesn't shrink in
+# proportion to the area, so scanning nearly a whole frame in pieces is
+# slower than scanning the frame.
+MAX_TILED_SCAN_AREA = 0.6
 
-def full_scan(frame):
+def set_detectors(full=None, delta=None):
     """
-    Process a single frame for face recognition and servo control.
+    Choose the detector backends (see `detectors.create_detector`) for full
+    scans and for delta scans, e.g. a strong one for the occasional full scan
+    and a cheap one for tracking.
+    """
+    with _models_lock:
+        for kind, name in (('full', full), ('delta', delta)):
+            if name is not None and name != _detector_names[kind]:
+                _detector_names[kind] = name
+                _detectors.pop(kind, None)
+
+
+def get_detector(kind):
+    """
+    The detector for "full" or "delta" scans, created on first use. Both kinds
+    share one detector when they use the same backend.
+    """
+    with _models_lock:
+        if kind not in _detectors:
+            name = _detector_names[kind]
+            shared = [detector for other, detector in _detectors.items() if _detector_names[other] == name]
+            _detectors[kind] = shared[0] if shared else create_detector(name)
+        return _detectors[kind]
+
+
+def get_matcher():
+    """
+    The matcher over the known faces, loaded on first use.
+    """
+    global _matcher
+    with _models_lock:
+        if _matcher is None:
+            # Load pre-trained face encodings
+            print("[INFO] loading encodings...")
+            gallery = load_gallery(GALLERY_PATH)
+
+            # Use the index built at training time, if there is one, for large
+            # galleries. Loaded first so that the matcher doesn't build a
+            # brute-force index, which would read the whole gallery.
+            index = load_index(index_path(GALLERY_PATH), gallery.encodings, gallery.fingerprint)
+            if index is not None:
+                print(f"[INFO] using {index.kind} gallery index")
+            _matcher = FaceMatcher(gallery.encodings, gallery.names, index=index)
+        return _matcher
+
+
+def get_face_recognition():
+    """
+    The `face_recognition` module, imported on first use as importing it loads dlib's models.
+    """
+    global _face_recognition
+    with _models_lock:
+        if _face_recognition is None:
+            import face_recognition
+
+            _face_recognition = face_recognition
+        return _face_recognition
+
+
+def warm_up():
+    """
+    Load every model and run each once on a blank image, so the first real
+    frame doesn't pay for loading or for the first-call setup of the networks.
+    Safe to run on a background thread: anything that needs a model while it
+    runs waits for that model.
+    """
+    warm_up_start = time.time()
+    blank = np.zeros((160, 160, 3), dtype=np.uint8)
+    for kind in ('full', 'delta'):
+        get_detector(kind).detect(blank)
+    get_face_recognition().face_encodings(blank, [(40, 120, 120, 40)], model='large')
+    get_matcher().match([np.zeros(128, dtype=np.float32)])
+    print(f"[INFO] face models ready in {time.time() - warm_up_start:.1f} s")
+
+
+def locate_faces(frame, scale=0.5):
+    """
+    Find the faces in a frame without recognizing them.
 
     Args:
         frame (ndarray): The image frame to process.
+        scale (float): How much to downscale the frame by before detection. Use
+            1.0 for frames that are already reduced, such as `Preprocessor` output.
 
     Returns:
         tuple: A tuple containing:
-            - face_locations (list): List of face locations found in the frame, normalized to (0 to 1.0) range.
-            - face_names (list): List of names corresponding to detected faces.
+            - rgb_resized_frame (ndarray): The downscaled RGB frame the faces were found in.
+            - face_locations (list): List of face locations in pixels of `rgb_resized_frame`.
             - timings (dict): Dictionary of timing measurements for processing steps.
     """
-    # Initialize variables
-    face_locations = []
-    face_encodings = []
-    face_names = []
     timings = {}
 
     # Downscale the frame to speed up face detection
-    scale = 0.5
-    resized_frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+    if scale != 1.0:
+        resized_frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+    else:
+        resized_frame = frame
 
     # Color conversion
     rgb_resized_frame = cv2.cvtColor(resized_frame, cv2.COLOR_BGR2RGB)
 
-    # Face location using MTCNN
-    face_location_start = time.time()
-    detections = detector.detect_faces(rgb_resized_frame)
-    timings['face_location'] = (time.time() - face_location_start) * 1000  # milliseconds
+    # Face location
+    with metrics.timer("full_scan.face_location") as timer:
+        face_locations = get_detector('full').detect(rgb_resized_frame)
+    timings['face_location'] = timer.ms
+
+    return rgb_resized_frame, face_locations, timings
+
+
+def locate_faces_in_regions(frame, regions):
+    """
+    Find the faces in some regions of a frame, such as the tiles picked by
+    `motion_tiles.MotionTileSelector`. The regions are cut out and go through
+    the full scan detector in one pass as a mosaic, and faces found twice
+    where regions overlap are merged. If the mosaic would be more than
+    `MAX_TILED_SCAN_AREA` of the frame, the whole frame is scanned instead as
+    that is cheaper.
+
+    Args:
+        frame (ndarray): The image frame to process, at the resolution to detect at.
+        regions (list): Normalized (top, right, bottom, left) boxes to scan.
+
+    Returns:
+        tuple: A tuple containing:
+            - rgb_frame (ndarray): The RGB frame the faces were found in.
+            - face_locations (list): List of face locations in pixels of `rgb_frame`.
+            - timings (dict): Dictionary of timing measurements for processing steps.
+    """
+    frame_height, frame_width = frame.shape[:2]
+    boxes = [
+        (int(top * frame_height), int(right * frame_width), int(bottom * frame_height), int(left * frame_width))
+        for (top, right, bottom, left) in regions
+    ]
+    if not tiled_scan_worthwhile(frame, regions):
+        return locate_faces(frame, scale=1.0)
+
+    timings = {'face_location': 0.0}
+    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    if not boxes:
+        return rgb_frame, [], timings
+
+    crops = [rgb_frame[top:bottom, left:right] for (top, right, bottom, left) in boxes]
+    with metrics.timer("full_scan.face_location") as timer:
+        mosaic, offsets = build_mosaic(crops, max_width=frame_width)
+        detections = get_detector('full').detect(mosaic)
+    timings['face_location'] = timer.ms
+
+    # Move each detection from the mosaic back to the frame, through the region its center falls in
+    face_locations = []
+    for (top, right, bottom, left) in detections:
+        center_x, center_y = (left + right) / 2, (top + bottom) / 2
+        for (offset_x, offset_y), crop, box in zip(offsets, crops, boxes):
+            if offset_x <= center_x < offset_x + crop.shape[1] and offset_y <= center_y < offset_y + crop.shape[0]:
+                shift_x, shift_y = box[3] - offset_x, box[0] - offset_y
+                face_locations.append((top + shift_y, right + shift_x, bottom + shift_y, left + shift_x))
+                break
+
+    return rgb_frame, non_max_suppression(face_locations), timings
+
+
+def non_max_suppression(face_locations, overlap_threshold=0.5):
+    """
+    Merge boxes that are the same face seen twice, such as in two overlapping
+    regions, keeping the larger box. Boxes are compared by how much of the
+    smaller one is covered, because a face cut off by a region border is found
+    as a smaller box inside the whole face.
+    """
+    def area(box):
+        top, right, bottom, left = box
+        return max(0, right - left) * max(0, bottom - top)
+
+    kept = []
+    for box in sorted(face_locations, key=area, reverse=True):
+        duplicate = False
+        for other in kept:
+            intersection = area((max(box[0], other[0]), min(box[1], other[1]), min(box[2], other[2]), max(box[3], other[3])))
+            if intersection > overlap_threshold * min(area(box), area(other)):
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(box)
+    return kept
 
-    # Extract face locations
-    for detection in detections:
-        x, y, width, height = detection['box']
-        top, right, bottom, left = y, x + width, y + height, x
-        face_locations.append((top, right, bottom, left))
+
+def identify_faces(rgb_frame, face_locations):
+    """
+    Encode faces and match them against the known faces.
+
+    Args:
+        rgb_frame (ndarray): An RGB image containing the faces.
+        face_locations (list): Face locations in pixels of `rgb_frame`.
+
+    Returns:
+        tuple: A tuple containing:
+            - face_encodings (list): The encoding of each face.
+            - matches (list): The `face_matcher.Match` for each face.
+            - timings (dict): Dictionary of timing measurements for processing steps.
+    """
+    timings = {}
 
     # Face encoding
-    face_encoding_start = time.time()
-    face_encodings = face_recognition.face_encodings(rgb_resized_frame, face_locations, model='large')
-    timings['face_encoding'] = (time.time() - face_encoding_start) * 1000  # milliseconds
+    with metrics.timer("face_encoding") as timer:
+        face_encodings = get_face_recognition().face_encodings(rgb_frame, face_locations, model='large')
+    timings['face_encoding'] = timer.ms
+
+    # Face matching, all faces against all known faces in one batch
+    with metrics.timer("face_matching") as timer:
+        matches = get_matcher().match(face_encodings)
+    timings['face_matching'] = timer.ms
+
+    return face_encodings, matches, timings
 
-    # Face matching
-    face_matching_start = time.time()
-    face_names = []
-    live = []
-    for face_encoding in face_encodings:
-        # See if the face is a match for the known face(s)
-        matches = face_recognition.compare_faces(known_face_encodings, face_encoding)
-        name = "Unknown"
-
-        # Use the known face with the smallest distance to the new face
-        face_distances = face_recognition.face_distance(known_face_encodings, face_encoding)
-        best_match_index = np.argmin(face_distances)
-        if matches[best_match_index]:
-            name = known_face_names[best_match_index]
-        face_names.append(name)
-        live.append(True)
-    timings['face_matching'] = (time.time() - face_matching_start) * 1000  # milliseconds
 
-    # Normalize face locations to 0..1.0 range so that servo control is independent of camera resolution
-    resized_frame_width = resized_frame.shape[1]
-    resized_frame_height = resized_frame.shape[0]
-    face_locations = [
+def recognize_faces(rgb_frame, face_locations):
+    """
+    Encode the faces found by `locate_faces` and match them against the known faces.
+
+    Args:
+        rgb_frame (ndarray): The RGB frame returned by `locate_faces`.
+        face_locations (list): Face locations in pixels of `rgb_frame`.
+
+    Returns:
+        tuple: A tuple containing:
+            - face_names (list): List of names corresponding to the faces.
+            - timings (dict): Dictionary of timing measurements for processing steps.
+    """
+    _, matches, timings = identify_faces(rgb_frame, face_locations)
+    return [match.name for match in matches], timings
+
+
+def match_faces(face_encodings):
+    """
+    Match face encodings against the known faces, returning a name (or
+    "Unknown") for each encoding.
+    """
+    # All faces are matched against all known faces in one batch
+    return [match.name for match in get_matcher().match(face_encodings)]
+
+
+def normalize_face_locations(face_locations, frame):
+    """
+    Normalize pixel face locations to 0..1.0 range so that servo control is
+    independent of camera resolution.
+    """
+    frame_width = frame.shape[1]
+    frame_height = frame.shape[0]
+    return [
         (
-            top / resized_frame_height,
-            right / resized_frame_width,
-            bottom / resized_frame_height,
-            left / resized_frame_width
+            top / frame_height,
+            right / frame_width,
+            bottom / frame_height,
+            left / frame_width
         )
         for (top, right, bottom, left) in face_locations
     ]
 
+
+def full_scan(frame):
+    """
+    Process a single frame for face recognition and servo control.
+
+    Args:
+        frame (ndarray): The image frame to process.
+
+    Returns:
+        tuple: A tuple containing:
+            - face_locations (list): List of face locations found in the frame, normalized to (0 to 1.0) range.
+            - face_names (list): List of names corresponding to detected faces.
+            - timings (dict): Dictionary of timing measurements for processing steps.
+    """
+    rgb_resized_frame, face_locations, timings = locate_faces(frame)
+
+    face_names, recognize_timings = recognize_faces(rgb_resized_frame, face_locations)
+    timings.update(recognize_timings)
+    live = [True] * len(face_names)
+
+    face_locations = normalize_face_locations(face_locations, rgb_resized_frame)
+
     return face_locations, face_names, live, timings
 
 
-def delta_scan(frame, previous_face_locations, previous_face_names, previous_live):
+def tiled_scan_worthwhile(frame, regions):
+    """
+    Whether scanning `regions` of `frame` as a mosaic is cheaper than scanning
+    the whole frame, judged by the area of the mosaic they would pack into.
+    """
+    frame_height, frame_width = frame.shape[:2]
+    sizes = [
+        (int(bottom * frame_height) - int(top * frame_height), int(right * frame_width) - int(left * frame_width))
+        for (top, right, bottom, left) in regions
+    ]
+    _, (mosaic_height, mosaic_width) = mosaic_layout(sizes, max_width=frame_width)
+    return mosaic_height * mosaic_width <= MAX_TILED_SCAN_AREA * frame_height * frame_width
+
+
+def mosaic_layout(sizes, gap=8, max_width=640):
+    """
+    Where `build_mosaic` places images of the given (height, width) sizes.
+
+    Returns:
+        tuple: A tuple containing:
+            - offsets (list): The (x, y) position of each image in the mosaic.
+            - size (tuple): The (height, width) of the mosaic.
+    """
+    offsets = []
+    x, y, row_height, mosaic_width = 0, 0, 0, 0
+    for height, width in sizes:
+        if x > 0 and x + width > max_width:
+            # Start a new row
+            x = 0
+            y += row_height + gap
+            row_height = 0
+        offsets.append((x, y))
+        x += width + gap
+        row_height = max(row_height, height)
+        mosaic_width = max(mosaic_width, x - gap)
+    return offsets, (y + row_height, mosaic_width)
+
+
+def build_mosaic(images, gap=8, max_width=640):
+    """
+    Pack images into one mosaic so they can go through the detector in a
+    single pass. Images are placed left to right in rows no wider than
+    `max_width`, separated by `gap` pixels of black so faces can't straddle two
+    images.
+
+    Returns:
+        tuple: A tuple containing:
+            - mosaic (ndarray): The packed image.
+            - offsets (list): The (x, y) position of each image in the mosaic.
+    """
+    offsets, (mosaic_height, mosaic_width) = mosaic_layout([image.shape[:2] for image in images], gap, max_width)
+    mosaic = np.zeros((mosaic_height, mosaic_width, images[0].shape[2]), dtype=images[0].dtype)
+    for image, (x, y) in zip(images, offsets):
+        mosaic[y:y + image.shape[0], x:x + image.shape[1]] = image
+    return mosaic, offsets
+
+
+def delta_scan(frame, previous_face_locations, previous_face_names, previous_live,
+               crop_width=50, margin=0.3, lost_crop_width=150, lost_margin=1.0):
+    """
+    Re-find tracked faces by running the detector on a small crop around each.
+
+    A face that was found last time is looked for in a crop `margin` times
+    its size bigger on each side, shrunk to `crop_width` pixels wide. A face
+    that was lost gets the wider `lost_margin` and sharper `lost_crop_width`.
+    Smaller crops are cheaper to detect in but find fewer faces.
+
+    Returns:
+        tuple: A tuple containing:
+            - face_locations (list): The new normalized location of each face, or its old one if it wasn't found.
+            - face_names (list): The names passed in.
+            - live (list): Whether each face was found. A face that is mostly out of the frame isn't looked for.
+            - timings (dict): Dictionary of timing measurements for processing steps.
+    """
     face_locations = []
     face_names = []
     live = []
@@ -103,23 +394,26 @@ def delta_scan(frame, previous_face_locations, previous_face_names, previous_liv
 
     frame_height, frame_width, _ = frame.shape
 
-    for (top_norm, right_norm, bottom_norm, left_norm), name in zip(previous_face_locations, previous_face_names):
+    # Crop and shrink the region around each face
+    regions = []
+    crops = []
+    for (top_norm, right_norm, bottom_norm, left_norm), was_live in zip(previous_face_locations, previous_live):
         # Scale normalized coordinates to pixel values and round them
         top = int(top_norm * frame_height)
         right = int(right_norm * frame_width)
         bottom = int(bottom_norm * frame_height)
         left = int(left_norm * frame_width)
 
-        if previous_live:
-            margin = 0.3
-            width_new = 50
+        if was_live:
+            face_margin = margin
+            width_new = crop_width
         else:
-            margin = 1.0
-            width_new = 150
+            face_margin = lost_margin
+            width_new = lost_crop_width
 
         # Calculate margins
-        margin_v = int((bottom - top) * margin)
-        margin_h = int((right - left) * margin)
+        margin_v = int((bottom - top) * face_margin)
+        margin_h = int((right - left) * face_margin)
 
         # Define new region with margins and ensure coordinates are within frame bounds
         top_new = max(0, top - margin_v)
@@ -127,31 +421,61 @@ def delta_scan(frame, previous_face_locations, previous_face_names, previous_liv
         left_new = max(0, left - margin_h)
         right_new = min(frame_width, right + margin_h)
 
+        # A face that has mostly left the frame can't be found in what is left
+        # of it, and its crop may be empty
+        visible_width = min(frame_width, right) - max(0, left)
+        visible_height = min(frame_height, bottom) - max(0, top)
+        if visible_width * 2 < right - left or visible_height * 2 < bottom - top or visible_width <= 0 or visible_height <= 0:
+            regions.append(None)
+            continue
+
         # Crop the region
         cropped_frame = frame[top_new:bottom_new, left_new:right_new]
 
         # Resize to speed up face detection
         scale = width_new / (right_new - left_new)
         height_new = int((bottom_new - top_new) * scale)
+        if height_new < 1:
+            regions.append(None)
+            continue
         resized_cropped_frame = cv2.resize(cropped_frame, (width_new, height_new))
 
-        # Face detection on cropped image using MTCNN
-        face_location_start = time.time()
-        rgb_cropped_frame = cv2.cvtColor(resized_cropped_frame, cv2.COLOR_BGR2RGB)
-        detections = detector.detect_faces(rgb_cropped_frame)
-        timings['face_location'] += (time.time() - face_location_start) * 1000  # Accumulate time in milliseconds
+        regions.append((top_new, right_new, bottom_new, left_new, width_new, height_new))
+        crops.append(cv2.cvtColor(resized_cropped_frame, cv2.COLOR_BGR2RGB))
 
+    # Face detection on all the cropped images at once, so the per-call
+    # overhead is paid once per frame rather than once per face
+    detections_per_crop = [[] for _ in crops]
+    if crops:
+        with metrics.timer("delta_scan.face_location") as timer:
+            mosaic, offsets = build_mosaic(crops)
+            detections = get_detector('delta').detect(mosaic)
+        timings['face_location'] += timer.ms
+
+        # Hand each detection to the crop its center falls in, relative to that crop
+        for (top, right, bottom, left) in detections:
+            center_x, center_y = (left + right) / 2, (top + bottom) / 2
+            for i, ((offset_x, offset_y), crop) in enumerate(zip(offsets, crops)):
+                if offset_x <= center_x < offset_x + crop.shape[1] and offset_y <= center_y < offset_y + crop.shape[0]:
+                    detections_per_crop[i].append((top - offset_y, right - offset_x, bottom - offset_y, left - offset_x))
+                    break
+
+    # Faces that weren't cropped have no detections
+    crop_detections = iter(detections_per_crop)
+    for face_location, name, region in zip(previous_face_locations, previous_face_names, regions):
+        detections = next(crop_detections) if region is not None else []
         if len(detections) != 1:
+            metrics.count("delta_scan.failed")
             # Fall back to previous face location
             live.append(False)
-            face_locations.append((top_norm, right_norm, bottom_norm, left_norm))
+            face_locations.append(face_location)
             face_names.append(name)
             continue
 
+        top_new, right_new, bottom_new, left_new, width_new, height_new = region
+
         # Extract face location from detection
-        detection = detections[0]
-        x, y, width, height = detection['box']
-        top_cropped, right_cropped, bottom_cropped, left_cropped = y, x + width, y + height, x
+        top_cropped, right_cropped, bottom_cropped, left_cropped = detections[0]
 
         # Scale back up to the size of the cropped image
         top_rescaled = top_new + int(top_cropped / height_new * (bottom_new - top_new))
@@ -169,4 +493,4 @@ def delta_scan(frame, previous_face_locations, previous_face_names, previous_liv
         face_names.append(name)
         live.append(True)
 
-    return face_locations, face_names, live, timings
\ No newline at end of file
+    return face_locations, face_names, live, timings
@@ -0,0 +1,342 @@
+import os
+import threading
+import time
+import cv2
+import numpy as np
+
+# All sources produce 4-channel frames like the camera's XRGB8888 mode (which
+# OpenCV sees as BGRA), at the camera's resolution unless told otherwise
+DEFAULT_SIZE = (1920, 1080)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+class FrameSource:
+    """
+    Base class for anything that produces camera frames. Subclasses implement
+    `_read_frame`, returning a frame or None when the source is exhausted.
+
+    Replay sources either run at max speed or, when `realtime` is set, are
+    paced to `fps` so they behave like the live camera.
+    """
+
+    fps = 30.0
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self._next_frame_time = None
+        self.last_frame = None
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def read(self):
+        """
+        Return the next frame, or None if there are no more frames.
+        """
+        if self.realtime:
+            now = time.time()
+            if self._next_frame_time is None:
+                self._next_frame_time = now
+            elif now < self._next_frame_time:
+                time.sleep(self._next_frame_time - now)
+            self._next_frame_time += 1 / self.fps
+        self.last_frame = self._read_frame()
+        return self.last_frame
+
+    def full_resolution(self):
+        """
+        Return a full resolution frame, for when more detail is needed than
+        `read` gives. For sources whose frames are already full resolution
+        this is just the last frame read.
+        """
+        return self.last_frame
+
+    def _read_frame(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def to_camera_format(image, size=None):
+    """
+    Convert a BGR or grayscale image to the 4-channel layout of the camera
+    frames, optionally resizing it to `size` (width, height).
+    """
+    if size is not None and (image.shape[1], image.shape[0]) != tuple(size):
+        image = cv2.resize(image, tuple(size))
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
+    if image.shape[2] == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+    return image
+
+
+class PicameraSource(FrameSource):
+    """
+    Live frames from the Raspberry Pi camera.
+
+    With `lores_size` set the camera runs two streams: a small YUV420 `lores`
+    stream that `read` returns (converted to BGRA) for detection and tracking,
+    and the full `size` main stream, which is only copied out of the camera
+    when `full_resolution` asks for it. This saves copying and converting the
+    full frame every time.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, controls=None, lores_size=None):
+        super().__init__(realtime=False)
+        self.size = tuple(size)
+        self.controls = controls
+        self.lores_size = tuple(lores_size) if lores_size is not None else None
+        self.picam2 = None
+        self._full_condition = threading.Condition()
+        self._full_wanted = False
+        self._full_frame = None
+
+    def start(self):
+        # Imported here so the replay sources work on machines without the camera stack
+        from picamera2 import Picamera2
+
+        self.picam2 = Picamera2()
+        if self.lores_size is not None:
+            # The Pi 4 ISP can only produce YUV420 on the lores stream
+            config = self.picam2.create_preview_configuration(
+                main={"format": 'XRGB8888', "size": self.size},
+                lores={"format": 'YUV420', "size": self.lores_size})
+        else:
+            config = self.picam2.create_preview_configuration(main={"format": 'XRGB8888', "size": self.size})
+        self.picam2.configure(config)
+        if self.controls:
+            self.picam2.set_controls(self.controls)
+        self.picam2.start()
+
+    def stop(self):
+        if self.picam2 is not None:
+            self.picam2.stop()
+            self.picam2 = None
+        with self._full_condition:
+            self._full_condition.notify_all()
+
+    def _read_frame(self):
+        if self.lores_size is None:
+            return self.picam2.capture_array()
+
+        if self._full_wanted:
+            # Take both streams from the same request so they show the same moment
+            request = self.picam2.capture_request()
+            try:
+                lores = request.make_array("lores")
+                full_frame = request.make_array("main")
+            finally:
+                request.release()
+            with self._full_condition:
+                self._full_frame = full_frame
+                self._full_wanted = False
+                self._full_condition.notify_all()
+        else:
+            lores = self.picam2.capture_array("lores")
+        return cv2.cvtColor(lores, cv2.COLOR_YUV2BGRA_I420)
+
+    def full_resolution(self, timeout=1.0):
+        """
+        Return a frame from the main stream. In dual-stream mode this waits for
+        the thread calling `read` to capture the next one, and returns None if
+        that doesn't happen within `timeout` seconds.
+        """
+        if self.lores_size is None:
+            return super().full_resolution()
+        with self._full_condition:
+            self._full_frame = None
+            self._full_wanted = True
+            self._full_condition.wait_for(lambda: self._full_frame is not None or self.picam2 is None, timeout)
+            full_frame = self._full_frame
+            self._full_frame = None
+            return full_frame
+
+
+class VideoFileSource(FrameSource):
+    """
+    Replays a recorded video file.
+    """
+
+    def __init__(self, path, realtime=False, size=None, loop=False):
+        super().__init__(realtime)
+        self.path = path
+        self.size = size
+        self.loop = loop
+        self.capture = None
+
+    def start(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            raise IOError(f"Could not open video file {self.path}")
+        fps = self.capture.get(cv2.CAP_PROP_FPS)
+        if fps > 0:
+            self.fps = fps
+
+    def stop(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def _read_frame(self):
+        ok, image = self.capture.read()
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, image = self.capture.read()
+        if not ok:
+            return None
+        return to_camera_format(image, self.size)
+
+
+class ImageDirectorySource(FrameSource):
+    """
+    Replays the images in a directory (recursively, in sorted order), such as
+    the `dataset` folder.
+    """
+
+    def __init__(self, path, realtime=False, size=DEFAULT_SIZE, fps=30.0, loop=False):
+        super().__init__(realtime)
+        self.path = path
+        self.size = size
+        self.fps = fps
+        self.loop = loop
+        self.image_paths = []
+        self.index = 0
+
+    def start(self):
+        self.image_paths = sorted(
+            os.path.join(root, filename)
+            for root, _, filenames in os.walk(self.path)
+            for filename in filenames
+            if filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if not self.image_paths:
+            raise IOError(f"No images found in {self.path}")
+        self.index = 0
+
+    def _read_frame(self):
+        skipped = 0
+        while True:
+            if self.index >= len(self.image_paths):
+                # Give up on a looping directory once every image has failed
+                if not self.loop or skipped >= len(self.image_paths):
+                    return None
+                self.index = 0
+            path = self.image_paths[self.index]
+            image = cv2.imread(path)
+            self.index += 1
+            if image is not None:
+                return to_camera_format(image, self.size)
+            print(f"[WARNING] could not read {path}, skipping it")
+            skipped += 1
+
+
+# Raw frame dumps start with a small header (magic, height, width, channels as
+# little-endian uint32) followed by the uint8 frames back to back
+FRAME_DUMP_MAGIC = b"FTSF"
+FRAME_DUMP_HEADER = np.dtype([('magic', 'S4'), ('height', '<u4'), ('width', '<u4'), ('channels', '<u4')])
+
+
+class FrameDumpSource(FrameSource):
+    """
+    Replays a raw frame dump written by `FrameDumpWriter`. The file is
+    memory-mapped so frames are read straight from the page cache without any
+    decoding.
+    """
+
+    def __init__(self, path, realtime=False, fps=30.0, loop=False):
+        super().__init__(realtime)
+        self.path = path
+        self.fps = fps
+        self.loop = loop
+        self.frames = None
+        self.index = 0
+
+    def start(self):
+        header = np.fromfile(self.path, dtype=FRAME_DUMP_HEADER, count=1)
+        if len(header) != 1 or header[0]['magic'] != FRAME_DUMP_MAGIC:
+            raise IOError(f"{self.path} is not a frame dump")
+        shape = (int(header[0]['height']), int(header[0]['width']), int(header[0]['channels']))
+        frame_size = shape[0] * shape[1] * shape[2]
+        count = (os.path.getsize(self.path) - FRAME_DUMP_HEADER.itemsize) // frame_size
+        self.frames = np.memmap(self.path, dtype=np.uint8, mode='r', offset=FRAME_DUMP_HEADER.itemsize, shape=(count,) + shape)
+        self.index = 0
+
+    def stop(self):
+        self.frames = None
+
+    def _read_frame(self):
+        if self.index >= len(self.frames):
+            if not self.loop or len(self.frames) == 0:
+                return None
+            self.index = 0
+        frame = self.frames[self.index]
+        self.index += 1
+        return frame
+
+
+class FrameDumpWriter:
+    """
+    Appends frames to a raw frame dump that `FrameDumpSource` can replay. All
+    frames must have the shape of the first one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.shape = None
+        self.file = None
+        self.count = 0
+
+    def write(self, frame):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if self.file is None:
+            self.shape = frame.shape
+            self.file = open(self.path, "wb")
+            header = np.array([(FRAME_DUMP_MAGIC,) + self.shape], dtype=FRAME_DUMP_HEADER)
+            self.file.write(header.tobytes())
+        elif frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match the dump's {self.shape}")
+        self.file.write(frame.data)
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_frame_source(spec="picamera", realtime=True, size=DEFAULT_SIZE, controls=None, lores_size=None):
+    """
+    Create a frame source from a string: "picamera" for the live camera, a
+    directory of images, a `.frames` raw frame dump, or any video file OpenCV can read.
+    `controls` and `lores_size` only apply to the camera.
+    """
+    if spec == "picamera":
+        return PicameraSource(size=size, controls=controls, lores_size=lores_size)
+    if os.path.isdir(spec):
+        return ImageDirectorySource(spec, realtime=realtime, size=size)
+    if spec.endswith(".frames"):
+        return FrameDumpSource(spec, realtime=realtime)
+    return VideoFileSource(spec, realtime=realtime, size=size)
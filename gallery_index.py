@@ -0,0 +1,387 @@
+import os
+import numpy as np
+from encodings_store import gallery_fingerprint
+
+
+def squared_distances(queries, encodings, encoding_squared_norms=None):
+    """
+    Squared Euclidean distance from each query (rows) to each encoding
+    (columns), computed as a single matrix product.
+    """
+    if encoding_squared_norms is None:
+        encoding_squared_norms = np.einsum('ij,ij->i', encodings, encodings)
+    query_squared_norms = np.einsum('ij,ij->i', queries, queries)
+    squared = query_squared_norms[:, None] + encoding_squared_norms[None, :] - 2 * (queries @ encodings.T)
+    # Rounding can push the distance of near-identical encodings slightly below zero
+    np.maximum(squared, 0, out=squared)
+    return squared
+
+
+def save_arrays(path, **arrays):
+    """
+    `np.savez` to a file next to `path`, then moved into place, so processes
+    loading the index (or saving it at the same time) never see a partial file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def nearest_k(distances, k):
+    """
+    Column indices of the `k` smallest distances in each row, nearest first.
+    """
+    k = min(k, distances.shape[1])
+    if k < distances.shape[1]:
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        nearest = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+
+class BruteForceIndex:
+    """
+    Exact search: every query is compared with every known encoding.
+    """
+
+    kind = "brute_force"
+    # Of the gallery the index was built for, see `encodings_store.gallery_fingerprint`
+    fingerprint = None
+
+    def build(self, encodings):
+        self.encodings = encodings
+        self.squared_norms = np.einsum('ij,ij->i', encodings, encodings)
+        return self
+
+    def search(self, queries, k=1):
+        """
+        Find the `k` nearest encodings to each query.
+
+        Returns:
+            tuple: A tuple containing:
+                - distances (ndarray): (queries, k) Euclidean distances, nearest first.
+                - indices (ndarray): (queries, k) indices into the encodings.
+        """
+        squared = squared_distances(queries, self.encodings, self.squared_norms)
+        indices = nearest_k(squared, k)
+        return np.sqrt(np.take_along_axis(squared, indices, axis=1)), indices
+
+    def save(self, path):
+        save_arrays(path, kind=self.kind, fingerprint=self.fingerprint or "")
+
+    def _load(self, data, encodings):
+        return self.build(encodings)
+
+    @staticmethod
+    def _options(data):
+        return {}
+
+
+class IVFIndex:
+    """
+    Approximate search with an inverted file: the encodings are clustered with
+    k-means at training time, and a query is only compared with the encodings
+    in the `n_probe` clusters whose centroids are closest to it.
+
+    Args:
+        n_lists (int): Number of clusters. Defaults to the square root of the gallery size.
+        n_probe (int): Number of clusters searched per query. More is slower but
+            finds the true nearest neighbour more often.
+    """
+
+    kind = "ivf"
+    # Of the gallery the index was built for, see `encodings_store.gallery_fingerprint`
+    fingerprint = None
+
+    def __init__(self, n_lists=None, n_probe=8, iterations=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.seed = seed
+
+    def build(self, encodings):
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(encodings))))
+        n_lists = min(n_lists, len(encodings))
+        rng = np.random.default_rng(self.seed)
+
+        # Plain k-means, seeded from a random sample of the encodings
+        centroids = encodings[rng.choice(len(encodings), n_lists, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignments = self._assign(encodings, centroids)
+            counts = np.bincount(assignments, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, encodings)
+            # Empty clusters keep their previous centroid
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        assignments = self._assign(encodings, centroids)
+
+        self._set_lists(encodings, centroids, assignments)
+        return self
+
+    def _assign(self, encodings, centroids, chunk_size=4096):
+        # Chunked so a large gallery doesn't need a gallery x centroids matrix at once
+        centroid_squared_norms = np.einsum('ij,ij->i', centroids, centroids)
+        return np.concatenate([
+            np.argmin(squared_distances(encodings[i:i + chunk_size], centroids, centroid_squared_norms), axis=1)
+            for i in range(0, len(encodings), chunk_size)
+        ])
+
+    def _set_lists(self, encodings, centroids, assignments, squared_norms=None, chunk_size=65536):
+        self.encodings = encodings
+        self.centroids = centroids
+        self.n_lists = len(centroids)
+        # The row IDs grouped by cluster, so each list is a contiguous slice of
+        # them. Only the IDs are kept: the rows are read from the (memory-mapped)
+        # gallery when searched, rather than copying the whole gallery.
+        self.ids = np.argsort(assignments, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.n_lists))])
+        self.assignments = assignments
+        if squared_norms is None:
+            # Chunked so a memory-mapped gallery isn't copied whole
+            squared_norms = np.concatenate([
+                np.einsum('ij,ij->i', encodings[i:i + chunk_size], encodings[i:i + chunk_size])
+                for i in range(0, len(encodings), chunk_size)
+            ])
+        self.squared_norms = squared_norms
+
+    def search(self, queries, k=1):
+        """
+        Find (approximately) the `k` nearest encodings to each query. Rows with
+        fewer than `k` candidates are padded with infinite distances and index -1.
+
+        Returns:
+            tuple: A tuple containing:
+                - distances (ndarray): (queries, k) Euclidean distances, nearest first.
+                - indices (ndarray): (queries, k) indices into the encodings.
+        """
+        n_probe = min(self.n_probe, self.n_lists)
+        probed = nearest_k(squared_distances(queries, self.centroids), n_probe)
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, lists) in enumerate(zip(queries, probed)):
+            rows = np.concatenate([self.ids[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+            if len(rows) == 0:
+                continue
+            # Sorted so the memory-mapped gallery is read in order
+            rows.sort()
+            squared = squared_distances(query[None, :], np.asarray(self.encodings[rows]), self.squared_norms[rows])
+            nearest = nearest_k(squared, k)[0]
+            distances[row, :len(nearest)] = np.sqrt(squared[0, nearest])
+            indices[row, :len(nearest)] = rows[nearest]
+        return distances, indices
+
+    def save(self, path):
+        save_arrays(path, kind=self.kind, fingerprint=self.fingerprint or "", centroids=self.centroids,
+                    assignments=self.assignments, squared_norms=self.squared_norms, n_probe=self.n_probe)
+
+    def _load(self, data, encodings):
+        self.n_probe = int(data['n_probe'])
+        # Stored so that loading doesn't read the whole gallery; older index files don't have them
+        squared_norms = data['squared_norms'] if 'squared_norms' in data else None
+        self._set_lists(encodings, data['centroids'], data['assignments'], squared_norms)
+        return self
+
+    @staticmethod
+    def _options(data):
+        return {'n_probe': int(data['n_probe'])}
+
+
+def quantize(encodings):
+    """
+    Store encodings as int8, with a scale per encoding so each one uses the
+    full -127..127 range.
+
+    Returns:
+        tuple: A tuple containing:
+            - codes (ndarray): The int8 encodings.
+            - scales (ndarray): The float32 scale of each encoding.
+    """
+    scales = (np.abs(encodings).max(axis=1) / 127).astype(np.float32)
+    scales[scales == 0] = 1.0
+    return np.round(encodings / scales[:, None]).astype(np.int8), scales
+
+
+def dequantize(codes, scales):
+    encodings = codes.astype(np.float32)
+    encodings *= scales[:, None]
+    return encodings
+
+
+class QuantizedIndex:
+    """
+    Search over encodings held as int8 (a quarter of the memory of float32),
+    so scanning a large gallery reads far less memory. The `rerank` nearest by
+    the quantized distances are then re-ranked by their exact float32
+    distances, which only touches those few rows of the (memory-mapped)
+    float32 gallery.
+
+    There is no float16 option: converting float16 to float32 for the dot
+    products costs more than the memory it saves, several times slower than
+    brute force over the float32 gallery.
+
+    Args:
+        rerank (int): Candidates per query to re-rank exactly.
+        chunk_size (int): Encodings converted to float32 at a time while
+            scanning. Small enough that the buffer stays in the CPU cache.
+    """
+
+    kind = "quantized"
+    # Of the gallery the index was built for, see `encodings_store.gallery_fingerprint`
+    fingerprint = None
+
+    def __init__(self, rerank=16, chunk_size=1024):
+        self.rerank = rerank
+        self.chunk_size = chunk_size
+
+    def build(self, encodings):
+        codes, scales = quantize(np.asarray(encodings, dtype=np.float32))
+        return self._set_codes(encodings, codes, scales)
+
+    def _set_codes(self, encodings, codes, scales):
+        self.encodings = encodings
+        self.codes = codes
+        self.scales = scales
+        self.squared_norms = np.concatenate([
+            np.einsum('ij,ij->i', chunk, chunk)
+            for chunk in (self._dequantize(i) for i in range(0, len(codes), self.chunk_size))
+        ]) if len(codes) else np.zeros(0, dtype=np.float32)
+        return self
+
+    def _dequantize(self, start):
+        end = start + self.chunk_size
+        return dequantize(self.codes[start:end], self.scales[start:end])
+
+    def search(self, queries, k=1):
+        """
+        Find (approximately) the `k` nearest encodings to each query.
+
+        Returns:
+            tuple: A tuple containing:
+                - distances (ndarray): (queries, k) exact Euclidean distances, nearest first.
+                - indices (ndarray): (queries, k) indices into the encodings.
+        """
+        # Ranked by |x|^2 - 2 x.q, leaving out |q|^2 which is the same for every
+        # encoding. Codes are converted a chunk at a time into one reused
+        # buffer, and the scales are applied to the dot products rather than
+        # to every element.
+        approximate = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        buffer = np.empty((min(self.chunk_size, len(self.codes)), self.codes.shape[1]), dtype=np.float32)
+        queries_t = np.ascontiguousarray(queries.T)
+        for start in range(0, len(self.codes), self.chunk_size):
+            chunk = buffer[:len(self.codes[start:start + self.chunk_size])]
+            chunk[...] = self.codes[start:start + len(chunk)]
+            dots = (chunk @ queries_t).T
+            dots *= self.scales[start:start + len(chunk)]
+            approximate[:, start:start + len(chunk)] = self.squared_norms[start:start + len(chunk)] - 2 * dots
+        candidates = nearest_k(approximate, max(k, self.rerank))
+
+        k = min(k, candidates.shape[1])
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        for row, (query, rows) in enumerate(zip(queries, candidates)):
+            # Sorted so the memory-mapped gallery is read in order
+            rows = np.sort(rows)
+            squared = squared_distances(query[None, :], np.asarray(self.encodings[rows]))
+            nearest = nearest_k(squared, k)[0]
+            distances[row] = np.sqrt(squared[0, nearest])
+            indices[row] = rows[nearest]
+        return distances, indices
+
+    def save(self, path):
+        save_arrays(path, kind=self.kind, fingerprint=self.fingerprint or "", rerank=self.rerank,
+                    codes=self.codes, scales=self.scales)
+
+    def _load(self, data, encodings):
+        if data['codes'].dtype != np.int8:
+            # Saved when float16 was an option; rebuilt as int8
+            return None
+        self.rerank = int(data['rerank'])
+        return self._set_codes(encodings, data['codes'], data['scales'])
+
+    @staticmethod
+    def _options(data):
+        return {'rerank': int(data['rerank'])}
+
+
+INDEX_TYPES = {
+    BruteForceIndex.kind: BruteForceIndex,
+    IVFIndex.kind: IVFIndex,
+    QuantizedIndex.kind: QuantizedIndex,
+}
+
+
+def build_index(encodings, kind="brute_force", fingerprint=None, **options):
+    """
+    Build a gallery index of the given kind over a float32 matrix of encodings.
+    Pass the gallery's `fingerprint` for an index that is going to be saved.
+    """
+    index = INDEX_TYPES[kind](**options).build(encodings)
+    index.fingerprint = fingerprint
+    return index
+
+
+def index_path(encodings_path):
+    """
+    Where the index for an encodings file is stored: next to it.
+    """
+    return os.path.splitext(encodings_path)[0] + ".index.npz"
+
+
+def saved_index_settings(path):
+    """
+    The kind and options of the index saved at `path`, or None if there is no
+    index file, for building the same kind of index again.
+
+    Returns:
+        tuple: A tuple containing:
+            - kind (str): The kind of index, a key of `INDEX_TYPES`.
+            - options (dict): The options it was built with.
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        kind = str(data['kind'])
+        return kind, INDEX_TYPES[kind]._options(data)
+
+
+def load_index(path, encodings, fingerprint=None):
+    """
+    Load an index saved by `save`, attaching it to the encodings it was built
+    from. Returns None if there is no index file, in which case the caller
+    should fall back to brute force. An index built for a different gallery
+    (or saved before indexes held a fingerprint, or in a format no longer
+    read) is rebuilt over `encodings`, with the same kind and options, and
+    saved in its place.
+
+    Args:
+        path (str): The index file.
+        encodings (ndarray): The gallery's encodings.
+        fingerprint (str): The fingerprint stored in the gallery file. Worked
+            out from `encodings` if not given, which reads the whole gallery.
+    """
+    if not os.path.exists(path):
+        return None
+    if fingerprint is None:
+        fingerprint = gallery_fingerprint(encodings)
+    with np.load(path) as data:
+        kind = str(data['kind'])
+        index_type = INDEX_TYPES[kind]
+        if 'fingerprint' in data and str(data['fingerprint']) == fingerprint:
+            # None when the file is in a format the index no longer reads
+            index = index_type()._load(data, encodings)
+            if index is not None:
+                index.fingerprint = fingerprint
+                return index
+        options = index_type._options(data)
+
+    if not len(encodings):
+        print(f"[WARNING] '{path}' was built for a different gallery, ignoring it")
+        return None
+    print(f"[WARNING] '{path}' was built for a different gallery or by an older version, rebuilding it")
+    index = build_index(encodings, kind, fingerprint, **options)
+    index.save(path)
+    return index
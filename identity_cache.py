@@ -0,0 +1,106 @@
+from collections import OrderedDict, namedtuple
+import cv2
+import numpy as np
+
+# What was last recognized for a track
+Identity = namedtuple("Identity", ["encoding", "name", "distance", "timestamp", "thumbnail"])
+
+
+def face_thumbnail(frame, face_location, size=16):
+    """
+    A tiny normalized grayscale image of a face, cheap enough to take every
+    frame, used to tell whether the face has changed since it was last encoded.
+    Returns None if the face is outside the frame.
+    """
+    frame_height, frame_width = frame.shape[:2]
+    top, right, bottom, left = face_location
+    top = max(0, int(top * frame_height))
+    bottom = min(frame_height, int(bottom * frame_height))
+    left = max(0, int(left * frame_width))
+    right = min(frame_width, int(right * frame_width))
+    if bottom - top < 2 or right - left < 2:
+        return None
+
+    crop = cv2.resize(frame[top:bottom, left:right], (size, size), interpolation=cv2.INTER_AREA)
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGRA2GRAY if crop.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+    # Normalized so that a change in exposure alone doesn't count as a change
+    thumbnail = crop.astype(np.float32).ravel()
+    thumbnail -= thumbnail.mean()
+    norm = np.linalg.norm(thumbnail)
+    return thumbnail / norm if norm > 0 else thumbnail
+
+
+class IdentityCache:
+    """
+    Remembers who each track was recognized as, so faces are only re-encoded
+    when it is likely to make a difference.
+
+    A track needs re-encoding when it has no entry, when its face looks
+    different from when it was encoded, or when the entry's confidence has
+    decayed. Confidence starts from how close the match was and halves every
+    `half_life` seconds. Entries expire after `ttl` seconds, and beyond
+    `max_size` entries the least recently used are evicted.
+
+    Args:
+        tolerance (float): The matcher's tolerance, to turn distances into confidence.
+        min_similarity (float): Correlation with the encoded face's thumbnail
+            below which the face counts as changed.
+        min_confidence (float): Confidence below which an entry is refreshed.
+        min_refresh_interval (float): Never re-encode a track more often than
+            this, in seconds, so unknown faces aren't encoded every frame.
+    """
+
+    def __init__(self, tolerance=0.6, min_similarity=0.6, min_confidence=0.2, half_life=10.0,
+                 min_refresh_interval=1.0, ttl=60.0, max_size=64):
+        self.tolerance = tolerance
+        self.min_similarity = min_similarity
+        self.min_confidence = min_confidence
+        self.half_life = half_life
+        self.min_refresh_interval = min_refresh_interval
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, track_id):
+        identity = self.entries.get(track_id)
+        if identity is not None:
+            self.entries.move_to_end(track_id)
+        return identity
+
+    def confidence(self, identity, now):
+        match_confidence = max(0.0, 1.0 - identity.distance / self.tolerance)
+        return match_confidence * 0.5 ** ((now - identity.timestamp) / self.half_life)
+
+    def needs_refresh(self, track_id, thumbnail, now):
+        identity = self.get(track_id)
+        refresh = identity is None or self._is_stale(identity, thumbnail, now)
+        if refresh:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return refresh
+
+    def _is_stale(self, identity, thumbnail, now):
+        age = now - identity.timestamp
+        if age >= self.ttl:
+            return True
+        if age < self.min_refresh_interval:
+            return False
+        if thumbnail is not None and identity.thumbnail is not None:
+            if float(np.dot(thumbnail, identity.thumbnail)) < self.min_similarity:
+                return True
+        return self.confidence(identity, now) < self.min_confidence
+
+    def put(self, track_id, encoding, name, distance, thumbnail, now):
+        self.entries[track_id] = Identity(encoding, name, distance, now, thumbnail)
+        self.entries.move_to_end(track_id)
+        self.expire(now)
+
+    def expire(self, now):
+        for track_id in [track_id for track_id, identity in self.entries.items() if now - identity.timestamp >= self.ttl]:
+            del self.entries[track_id]
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
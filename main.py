@@ -1,21 +1,27 @@
-import cv2
-import numpy as np
-from picamera2 import Picamera2
 import time
+# Taken before the other imports so the startup time includes them
+process_start_time = time.time()
+
+import argparse
+import cv2
+import threading
 import os
-from find_faces import full_scan, delta_scan
-from servo_control import servo_control
-
-print("[INFO] initializing camera...")
-# Initialize the camera
-picam2 = Picamera2()
-picam2.configure(picam2.create_preview_configuration(main={"format": 'XRGB8888', "size": (1920, 1080)}))
-# Adjust both exposure and ISO for better low-light performance
-picam2.set_controls({
-    "ExposureTime": 5000,
-    "AnalogueGain": 2.0  # This is equivalent to ISO adjustment
-})
-picam2.start()
+from find_faces import locate_faces, locate_faces_in_regions, identify_faces, normalize_face_locations, delta_scan, set_detectors, build_mosaic, warm_up
+from servo_control import ServoController, SimulatedServoKit, get_servo_kit
+from pipeline import Pipeline, DropOldestQueue
+from frame_source import open_frame_source
+from tracker import Tracker
+from world_frame import CameraPanModel
+from worker_pool import WorkerPool
+from scheduler import FullScanScheduler
+from motion_tiles import MotionTileSelector
+from detectors import DETECTORS
+from identity_cache import IdentityCache, face_thumbnail
+from metrics import metrics, JsonlExporter, PrometheusExporter
+from tracing import Tracer
+from preprocess import Preprocessor, crop_full_resolution_faces, PROCESSING_SIZE
+from preview import Preview
+from quality import QualityController
 
 frame_count = 0
 start_time = time.time()
@@ -24,42 +30,29 @@ fps = 0
 # Detect if running over SSH
 is_ssh = 'SSH_CONNECTION' in os.environ or 'SSH_CLIENT' in os.environ
 
-def draw_results(frame, face_locations, face_names, live):
-    frame_width = frame.shape[1]
-    frame_height = frame.shape[0]
-
-    # Display the results
-    for (top, right, bottom, left), name, live in zip(face_locations, face_names, live):
-        # Scale back up face locations since the frame we detected in was scaled
-        # (and convert them from float to int)
-        top = int(top * frame_height)
-        right = int(right * frame_width)
-        bottom = int(bottom * frame_height)
-        left = int(left * frame_width)
-
-        # If live, use green color, otherwise use red
-        color = (0, 255, 0) if live else (0, 0, 255)
-
-        # Draw a box around the face
-        cv2.rectangle(frame, (left, top), (right, bottom), color, 3)
+# Size of the preview window and stream
+PREVIEW_SIZE = (640, 360)
 
-        # Draw a label with a name below the face
-        cv2.rectangle(frame, (left -3, top - 35), (right+3, top), (244, 42, 3), cv2.FILLED)
-        font = cv2.FONT_HERSHEY_DUPLEX
-        cv2.putText(frame, name, (left + 6, top - 6), font, 1.0, (255, 255, 255), 1)
+# How often to print the metrics summary, in seconds
+STATS_INTERVAL = 5
 
-    return frame
-
-def adjust_brightness(frame, target_brightness=127):
-    # Calculate current average brightness
-    current_brightness = np.mean(cv2.cvtColor(frame, cv2.COLOR_BGRA2GRAY))
-
-    # Calculate brightness ratio
-    brightness_ratio = target_brightness / current_brightness
-
-    # Adjust brightness while keeping within bounds
-    adjusted = cv2.convertScaleAbs(frame, alpha=brightness_ratio, beta=0)
-    return adjusted
+def init_camera(source="picamera", realtime=True, dual_stream=True):
+    print(f"[INFO] initializing frame source {source}...")
+    frame_source = open_frame_source(
+        source,
+        realtime=realtime,
+        size=(1920, 1080),
+        # Detect and track on a small stream straight from the ISP, and only
+        # copy out the full resolution stream when recognition needs it
+        lores_size=PROCESSING_SIZE if dual_stream else None,
+        # Adjust both exposure and ISO for better low-light performance
+        controls={
+            "ExposureTime": 5000,
+            "AnalogueGain": 2.0  # This is equivalent to ISO adjustment
+        },
+    )
+    frame_source.start()
+    return frame_source
 
 def calculate_fps():
     global frame_count, start_time, fps
@@ -71,104 +64,480 @@ def calculate_fps():
         start_time = time.time()
     return fps
 
-# Initialize previous face data
-previous_face_locations = []
-previous_face_names = []
-previous_live = []
-last_full_scan_time = time.time()
-failed_delta_count = 0
+class TrackingState:
+    """
+    The face data carried from one frame to the next. The detect stage moves the
+    tracks, the full scan stage adds new faces and the recognize stage names
+    them, so access goes through `lock`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tracker = Tracker()
+        self.scheduler = FullScanScheduler()
+        self.failed_delta_count = 0
+
+def build_pipeline(frame_source, servo, preview=None, tiled_full_scans=False, tracer=None, pool=None, quality=None,
+                   pan_compensation=True):
+    pipeline = Pipeline()
+    state = TrackingState()
+    # Only used by the full scan stage
+    tile_selector = MotionTileSelector() if tiled_full_scans else None
+    # Only used by the recognize stage
+    identity_cache = IdentityCache()
+    # With a worker pool, detection and encoding are spread over its processes
+    scan_tracked_faces = pool.delta_scan if pool is not None else delta_scan
+    encode_faces = pool.identify_faces if pool is not None else identify_faces
+    # Where the camera was pointing when each frame was captured
+    pan_model = CameraPanModel(servo, camera_moves=pan_compensation)
+    # Seconds from process start to the first frame and the first tracked face
+    startup = {}
+
+    def apply_quality(settings):
+        with state.lock:
+            state.scheduler.cpu_budget = settings['cpu_budget']
+            state.scheduler.max_interval = settings['max_interval']
+            state.scheduler.failure_scale = settings['failure_scale']
+            state.tracker.redetect_interval = settings['redetect_interval']
 
-print("[INFO] starting main loop...")
-try:
-    while True:
-        # Start timing
-        cycle_start_time = time.time()
+    if quality is not None:
+        # The controller changes the scheduler and tracker knobs from its own thread
+        quality.apply = apply_quality
 
+    # Every queue holds a single item: each stage always works on the newest
+    # frame and anything it was too slow for is dropped rather than queued up.
+    preprocess_queue = DropOldestQueue(maxsize=1)
+    detect_queue = DropOldestQueue(maxsize=1)
+    full_scan_queue = DropOldestQueue(maxsize=1)
+    recognize_queue = DropOldestQueue(maxsize=1)
+    actuate_queue = DropOldestQueue(maxsize=1)
+
+    # Processed frames are written into the preprocessor's ring of buffers.
+    # The drop-oldest queues never hold the preprocess stage back, so however
+    # many buffers there are it can come round to the one a slow detect step is
+    # still using: the detect stage copies its frame out as soon as it takes it,
+    # and the ring only has to outlast the frames waiting in the detect queue.
+    preprocessor = Preprocessor(size=PROCESSING_SIZE, buffer_count=detect_queue.maxsize + 3)
+
+    def traced(name, func):
+        # Record when each stage handled each frame in the frame's trace
+        if tracer is None:
+            return func
+
+        def run(packet):
+            start = time.time()
+            result = func(packet)
+            if packet.get('trace') is not None:
+                tracer.record_stage(packet['trace'], name, start, time.time())
+            return result
+        return run
+
+    def annotate(packet, **fields):
+        if packet.get('trace') is not None:
+            packet['trace'].update(fields)
+
+    def capture():
         # Capture a frame from camera
-        frame = picam2.capture_array()
-
-        # Invert the frame on the y-axis because the camera is upside down
-        frame = cv2.flip(frame, -1)
-
-        # Add brightness adjustment before processing
-        frame = adjust_brightness(frame)
-
-        # Check if it's time for a full scan
-        time_since_last_full_scan = time.time() - last_full_scan_time
-        do_full_scan = False
-        if previous_face_locations is None:
-            print("First run, performing full scan")
-            do_full_scan = True
-        elif failed_delta_count > 10:
-            print("Too many failed delta scans, performing full scan")
-            do_full_scan = True
-        elif len(previous_face_locations) == 0:
-            print("No faces detected in previous frame, performing full scan")
-            do_full_scan = True
-        elif time_since_last_full_scan > 20:
-            print("Time since last full scan > 20 seconds, performing full scan")
-            do_full_scan = True
-
-        if not do_full_scan:
-            face_locations, face_names, live, timings = delta_scan(frame, previous_face_locations, previous_face_names, previous_live)
+        capture_start = time.time()
+        frame = frame_source.read()
+        if frame is None:
+            # A replayed recording has run out of frames
+            pipeline.stop_event.set()
+            return None
+        packet = {'frame': frame, 'capture_time': time.time()}
+        if 'first_frame' not in startup:
+            startup['first_frame'] = packet['capture_time'] - process_start_time
+            metrics.set_gauge("startup.first_frame_s", startup['first_frame'])
+        if tracer is not None:
+            packet['trace'] = tracer.begin(packet['capture_time'])
+            tracer.record_stage(packet['trace'], 'capture', capture_start, packet['capture_time'])
+            # Kept as captured, before preprocessing, so the dump replays like any recording
+            tracer.capture_frame(packet['trace'], frame)
+        return packet
+
+    def preprocess(packet):
+        # Downscale, flip and brightness-adjust in one go into a reused buffer
+        packet['frame'] = preprocessor.process(packet['frame'])
+        return packet
+
+    def detect(packet):
+        # Its own copy, as the preprocessor will write over its buffer
+        frame = packet['frame'].copy()
+        now = packet['capture_time']
+
+        # Follow the faces by motion prediction and correlation, and only run
+        # the detector on the tracks that have lost confidence
+        with state.lock:
+            # Take out the camera's own panning since the last frame first
+            if state.tracker.timestamp is not None:
+                state.tracker.pan(pan_model.image_shift(state.tracker.timestamp, now))
+            to_redetect = state.tracker.update(frame, now)
+            # What the delta scan is given, taken before it changes the tracks
+            redetect_locations = [track.face_location for track in to_redetect]
+            redetect_names = [track.name for track in to_redetect]
+            redetect_live = [track.live for track in to_redetect]
+        timings = {'face_location': 0.0, 'face_encoding': 0.0, 'face_matching': 0.0}
+        if to_redetect:
+            crop_settings = quality.delta_scan_settings() if quality is not None else {}
+            redetected_locations, _, redetected_live, timings = scan_tracked_faces(
+                frame, redetect_locations, redetect_names, redetect_live, **crop_settings)
+        with state.lock:
+            for i, track in enumerate(to_redetect):
+                if redetected_live[i]:
+                    state.tracker.correct(track, redetected_locations[i])
+                else:
+                    state.tracker.miss(track)
+            face_locations = state.tracker.face_locations()
+            face_names = state.tracker.face_names()
+            face_velocities = state.tracker.velocities()
+            live = state.tracker.live()
+            track_ids = state.tracker.ids()
             if all(live):
-                failed_delta_count = 0
+                state.failed_delta_count = 0
             else:
-                failed_delta_count += 1
+                state.failed_delta_count += 1
+
+            # New faces are found by full scans, which run in the background
+            # at a rate the scheduler picks so that tracking never stalls
+            state.scheduler.observe(frame)
+            do_full_scan = state.scheduler.should_scan(now, len(live), sum(live), state.failed_delta_count)
+            if do_full_scan:
+                state.scheduler.scan_started(now)
 
+        if to_redetect:
+            metrics.count("delta_scans")
+            metrics.count("delta_scan.faces", len(to_redetect))
         if do_full_scan:
-            face_locations, face_names, live, timings = full_scan(frame)
-            last_full_scan_time = time.time()
-            failed_delta_count = 0
+            metrics.count("full_scans")
+            lost_face_locations = [location for location, is_live in zip(face_locations, live) if not is_live]
+            # The detect stage's own copy of the frame, which nothing changes
+            full_scan_queue.put({'frame': frame, 'capture_time': now, 'lost_face_locations': lost_face_locations,
+                                 'trace': packet.get('trace')})
 
-        # Update previous face data
-        previous_face_locations = face_locations
-        previous_face_names = face_names
-        previous_live = live
+        if tracer is not None:
+            annotate(packet,
+                     redetect_locations=[list(location) for location in redetect_locations],
+                     redetect_live=redetect_live,
+                     failed_delta_count=state.failed_delta_count,
+                     tracks=len(track_ids),
+                     full_scan_reason=state.scheduler.reason if do_full_scan else None)
 
-        servo_control(face_locations)
+        packet.update({
+            'face_locations': face_locations,
+            'face_names': face_names,
+            'live': live,
+            'face_velocities': face_velocities,
+            'track_ids': track_ids,
+            'thumbnails': [face_thumbnail(frame, face_location) for face_location in face_locations],
+            'timings': timings,
+        })
+
+        if track_ids and 'first_tracked_frame' not in startup:
+            startup['first_tracked_frame'] = time.time() - process_start_time
+            metrics.set_gauge("startup.first_tracked_frame_s", startup['first_tracked_frame'])
+            print(f"[INFO] first face tracked {startup['first_tracked_frame']:.1f} s after startup "
+                  f"(first frame after {startup['first_frame']:.1f} s)")
 
         # Calculate and update FPS
-        fps = calculate_fps()
-
-        # Output timings for processing steps
-        print(f"fps: {fps:.1f}, "
-            # f"Resize: {timings['resize']:.2f} ms, "
-            # f"Color Conversion: {timings['color_conversion']:.2f} ms, "
-            f"Face Location: {timings['face_location']:.2f} ms, "
-            f"Face Encoding: {timings['face_encoding']:.2f} ms, "
-            f"Face Matching: {timings['face_matching']:.2f} ms"
-        )
-
-        # Display everything over the video feed.
-        if not is_ssh:
-            # Get the text and boxes to be drawn based on the processed frame
-            display_frame = draw_results(frame, face_locations, face_names, live)
-
-            # Resize the display_frame to 360p
-            display_frame = cv2.resize(display_frame, (640, 360))
-
-            # Attach FPS counter to the text and boxes
-            cv2.putText(display_frame, f"FPS: {fps:.1f}", (display_frame.shape[1] - 150, 30),
-                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-            cv2.imshow('Video', display_frame)
-
-            # Break the loop if 'q' is pressed
-            if cv2.waitKey(1) == ord("q"):
-                break
+        calculate_fps()
+        if preview is not None:
+            # Only every few frames is actually copied
+            preview.update_frame(frame, fps)
+        # Nothing after the detect stage needs the frame
+        del packet['frame']
+        return packet
 
-        if do_full_scan:
-            # Full scans are expensive, so sleep for a bit to avoid hitting the CPU too hard
-            time.sleep(1)
+    def full_scan(packet):
+        started = time.time()
+        frame = packet['frame']
+        # Under load the quality controller has full scans look at a smaller
+        # frame; the face locations come back normalized either way
+        scale = quality.settings['full_scan_scale'] if quality is not None else 1.0
+        scan_frame = frame if scale == 1.0 else cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # Only locate the faces here, the recognize stage puts names to them
+        # once they show up in the tracks
+        if tile_selector is not None:
+            # Only scan the parts of the frame that have changed since the last scan
+            tiles = tile_selector.select(frame, packet['lost_face_locations'])
+            regions = [tile_selector.tile_box(tile) for tile in tiles]
+            if pool is not None:
+                rgb_frame, pixel_face_locations, timings = pool.locate_faces_in_regions(scan_frame, regions)
+            else:
+                rgb_frame, pixel_face_locations, timings = locate_faces_in_regions(scan_frame, regions)
         else:
-            # Sleep to maintain constant frame rate and avoid high CPU usage
-            cycle_time = time.time() - cycle_start_time
-            # time.sleep(max(0, 1/15 - cycle_time))
-except KeyboardInterrupt:
-    # Allow script to be stopped with Ctrl+C when running over SSH
-    pass
-
-# By breaking the loop we run this code here which closes everything
-if not is_ssh:
-    cv2.destroyAllWindows()
-picam2.stop()
\ No newline at end of file
+            regions = None
+            if pool is not None:
+                rgb_frame, pixel_face_locations, timings = pool.locate_faces(scan_frame)
+            else:
+                rgb_frame, pixel_face_locations, timings = locate_faces(scan_frame, scale=1.0)
+        face_locations = normalize_face_locations(pixel_face_locations, rgb_frame)
+        with state.lock:
+            # Faces that are already tracked keep their IDs and names
+            # The camera may have panned while the scan ran
+            shift = pan_model.image_shift(packet['capture_time'], state.tracker.timestamp or packet['capture_time'])
+            state.tracker.merge(frame, face_locations, packet['capture_time'], regions, shift)
+            state.failed_delta_count = 0
+            state.scheduler.scan_finished(time.time() - started)
+
+        if regions is not None:
+            metrics.count("full_scan.tiles", len(regions))
+        annotate(packet, full_scan_faces=len(face_locations), full_scan_tiles=len(regions) if regions is not None else None)
+        return None
+
+    def recognize(packet):
+        # Only encode the faces whose cached identity is missing, has changed
+        # or is no longer trusted; everyone else keeps their cached name
+        now = packet['capture_time']
+        names_by_id = {}
+        stale_ids = []
+        for track_id, thumbnail in zip(packet['track_ids'], packet['thumbnails']):
+            if identity_cache.needs_refresh(track_id, thumbnail, now):
+                stale_ids.append(track_id)
+            else:
+                names_by_id[track_id] = identity_cache.get(track_id).name
+        metrics.count("faces_cached", len(names_by_id))
+        annotate(packet, faces_cached=len(names_by_id), faces_encoded=len(stale_ids))
+
+        if stale_ids:
+            names_by_id.update(identify(stale_ids, dict(zip(packet['track_ids'], packet['thumbnails'])), packet, now))
+
+        packet['face_names'] = [names_by_id.get(track_id, name) for track_id, name in zip(packet['track_ids'], packet['face_names'])]
+        with state.lock:
+            state.tracker.set_names(names_by_id)
+        if preview is not None:
+            preview.update_faces(packet['face_locations'], packet['face_names'], packet['live'])
+        return None
+
+    def identify(track_ids, thumbnails, packet, now):
+        # Recognize from full resolution crops rather than the small frame the
+        # faces were detected in
+        full_frame = frame_source.full_resolution()
+        if full_frame is None:
+            return {}
+        with state.lock:
+            # The full resolution frame may be a little newer than the scan, so
+            # use where the tracker thinks the faces are now
+            current_locations = {track.id: track.face_location for track in state.tracker.tracks}
+        track_ids = [track_id for track_id in track_ids if track_id in current_locations]
+        if not track_ids:
+            return {}
+        crops, crop_face_locations = crop_full_resolution_faces(
+            full_frame, [current_locations[track_id] for track_id in track_ids], preprocessor.brightness_ratio)
+        # Faces that have gone out of the frame are left for another time
+        cropped = [(track_id, crop, location) for track_id, crop, location
+                   in zip(track_ids, crops, crop_face_locations) if crop is not None]
+        if not cropped:
+            return {}
+        track_ids, crops, crop_face_locations = (list(column) for column in zip(*cropped))
+
+        # Encode all the crops in one go
+        mosaic, offsets = build_mosaic(crops)
+        mosaic_face_locations = [
+            (top + y, right + x, bottom + y, left + x)
+            for (top, right, bottom, left), (x, y) in zip(crop_face_locations, offsets)
+        ]
+        face_encodings, matches, timings = encode_faces(mosaic, mosaic_face_locations)
+        packet['timings'].update(timings)
+        metrics.count("faces_encoded", len(track_ids))
+
+        for track_id, face_encoding, match in zip(track_ids, face_encodings, matches):
+            identity_cache.put(track_id, face_encoding, match.name, match.distance, thumbnails[track_id], now)
+        return {track_id: match.name for track_id, match in zip(track_ids, matches)}
+
+    def actuate(packet):
+        # Only aim the servo here; it follows the target on its own thread
+        # Only aim at the faces that are being followed, not the lost ones
+        # coasting until a full scan finds or drops them
+        face_locations = [location for location, is_live in zip(packet['face_locations'], packet['live']) if is_live]
+        face_velocities = [velocity for velocity, is_live in zip(packet['face_velocities'], packet['live']) if is_live]
+        if face_locations:
+            avg_x = sum([(left + right) / 2 for (top, right, bottom, left) in face_locations]) / len(face_locations)
+            avg_velocity_x = sum([velocity_x for velocity_x, _ in face_velocities]) / len(face_velocities)
+            # Aim at where the faces are in the world, from where the camera
+            # was pointing when the frame was captured
+            target = pan_model.image_to_pan(avg_x, packet['capture_time'])
+            servo.set_target(target, pan_model.pan_velocity(avg_velocity_x), packet['capture_time'])
+            annotate(packet, servo_target=target)
+        metrics.observe("photon_to_servo", (time.time() - packet['capture_time']) * 1000)  # milliseconds
+        return None
+
+    pipeline.add_stage('capture', capture, output_queues=[preprocess_queue])
+    pipeline.add_stage('preprocess', traced('preprocess', preprocess), preprocess_queue, [detect_queue])
+    # The servo is driven straight from detection so it doesn't wait on recognition
+    pipeline.add_stage('detect', traced('detect', detect), detect_queue, [recognize_queue, actuate_queue])
+    pipeline.add_stage('full_scan', traced('full_scan', full_scan), full_scan_queue)
+    pipeline.add_stage('recognize', traced('recognize', recognize), recognize_queue)
+    pipeline.add_stage('actuate', traced('actuate', actuate), actuate_queue)
+
+    return pipeline, state.scheduler
+
+def warm_up_in_background(load_models=True, open_servo=True):
+    """
+    Load the face models and open the servo on a background thread, while the
+    camera starts. Stages that need a model before it is ready wait for it.
+    """
+    def run():
+        try:
+            if load_models:
+                warm_up()
+            if open_servo:
+                get_servo_kit()
+        except Exception as e:
+            # Loading is tried again where it is needed: a model by the stage
+            # that uses it, which stops the pipeline if it fails again, and the
+            # servo by `ServoController.start`, which stops main
+            print(f"[WARNING] warm-up failed: {e!r}")
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def update_gauges(pipeline, scheduler):
+    """
+    Copy the pipeline and scheduler statistics into the metrics, so they are
+    exported along with everything else.
+    """
+    metrics.set_gauge("fps", fps)
+    for name, stats in pipeline.stats().items():
+        metrics.set_gauge(f"stage.{name}.rate", stats['rate'])
+        metrics.set_gauge(f"stage.{name}.occupancy", stats['occupancy'])
+        metrics.set_gauge(f"stage.{name}.queue_dropped", stats['queue_dropped'])
+    for name, value in scheduler.metrics().items():
+        metrics.set_gauge(f"scheduler.{name}", value)
+
+def main():
+    parser = argparse.ArgumentParser(description="Track faces with the servo stand")
+    parser.add_argument("--source", default="picamera",
+                        help="'picamera', a video file, a directory of images or a .frames dump to replay")
+    parser.add_argument("--max-speed", action="store_true",
+                        help="replay recordings as fast as possible instead of in real time")
+    parser.add_argument("--single-stream", action="store_true",
+                        help="capture only the full resolution camera stream instead of a separate small one for detection")
+    parser.add_argument("--full-detector", default="mtcnn", choices=list(DETECTORS),
+                        help="face detector for full scans of the whole frame")
+    parser.add_argument("--delta-detector", default="mtcnn", choices=list(DETECTORS),
+                        help="face detector for re-finding tracked faces")
+    parser.add_argument("--tiled-full-scans", action="store_true",
+                        help="only run full scans over the parts of the frame that have changed")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run detection and encoding in this many worker processes (0 runs them in this process)")
+    parser.add_argument("--simulate-servo", action="store_true",
+                        help="drive a simulated servo instead of the servo HAT")
+    parser.add_argument("--target-fps", type=float,
+                        help="adjust detection quality at runtime to hold this frame rate")
+    parser.add_argument("--latency-budget", type=float, metavar="MS",
+                        help="also lower detection quality when capture to servo takes longer than this on average")
+    parser.add_argument("--display", default="auto", choices=["auto", "on", "off"],
+                        help="show a preview window ('auto' shows it unless running over SSH)")
+    parser.add_argument("--preview-port", type=int,
+                        help="stream the preview as MJPEG at http://localhost:<port>/")
+    parser.add_argument("--preview-rate", type=float, default=10.0,
+                        help="preview frames per second")
+    parser.add_argument("--pan-compensation", default="auto", choices=["auto", "on", "off"],
+                        help="take the camera's own panning out of tracking and aiming ('auto' does so only "
+                             "for the camera driven by the real servo)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the metrics for Prometheus at http://<host>:<port>/metrics")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="address to serve the metrics on; use 0.0.0.0 to let other machines scrape them")
+    parser.add_argument("--metrics-file",
+                        help="append a snapshot of the metrics to this JSON lines file every few seconds")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="trace every frame and save the latest traces to this JSON lines file on exit")
+    parser.add_argument("--trace-capacity", type=int, default=1000,
+                        help="number of frame traces to keep")
+    parser.add_argument("--trace-frames", type=int, default=0,
+                        help="also keep this many of the latest frames, saved next to the trace for replaying with tracing.py")
+    args = parser.parse_args()
+
+    set_detectors(full=args.full_detector, delta=args.delta_detector)
+    # Worker processes load their own models, so this process doesn't need them
+    warm_up_in_background(load_models=args.workers == 0, open_servo=not args.simulate_servo)
+    pool = None
+    if args.workers > 0:
+        print(f"[INFO] starting {args.workers} worker processes...")
+        pool = WorkerPool(args.workers, full_detector=args.full_detector, delta_detector=args.delta_detector)
+    servo = ServoController(kit=SimulatedServoKit() if args.simulate_servo else None)
+    frame_source = init_camera(args.source, realtime=not args.max_speed, dual_stream=not args.single_stream)
+    tracer = Tracer(args.trace_capacity, args.trace_frames) if args.trace else None
+    show_window = args.display == "on" or (args.display == "auto" and not is_ssh)
+    preview = None
+    # Without a window or stream there is no preview at all, not even a thread
+    if show_window or args.preview_port is not None:
+        preview = Preview(PREVIEW_SIZE, args.preview_rate, window=show_window, mjpeg_port=args.preview_port)
+        if args.preview_port is not None:
+            print(f"[INFO] streaming preview on http://localhost:{args.preview_port}/...")
+    # A replayed recording doesn't turn with the servo, and nor does anything
+    # with a simulated one, so compensating would shift still faces around
+    pan_compensation = args.pan_compensation == "on" or (
+        args.pan_compensation == "auto" and args.source == "picamera" and not args.simulate_servo)
+    quality = None
+    if args.target_fps is not None or args.latency_budget is not None:
+        quality = QualityController(target_fps=args.target_fps or 15.0, latency_budget=args.latency_budget)
+    pipeline, scheduler = build_pipeline(frame_source, servo, preview=preview,
+                                         tiled_full_scans=args.tiled_full_scans, tracer=tracer, pool=pool, quality=quality,
+                                         pan_compensation=pan_compensation)
+
+    try:
+        servo.start()
+    except Exception as e:
+        # Tracking without a servo would look like it works while the stand never moves
+        print(f"[ERROR] could not open the servo: {e!r} (use --simulate-servo to run without it)")
+        frame_source.stop()
+        return
+
+    exporters = []
+    if args.metrics_port is not None:
+        print(f"[INFO] serving metrics on {args.metrics_host}:{args.metrics_port}...")
+        exporters.append(PrometheusExporter(metrics, args.metrics_port, args.metrics_host))
+    if args.metrics_file is not None:
+        exporters.append(JsonlExporter(metrics, args.metrics_file, interval=STATS_INTERVAL))
+    for exporter in exporters:
+        exporter.start()
+
+    if pool is not None:
+        pool.start()
+    print("[INFO] starting pipeline...")
+    if preview is not None:
+        # Quitting from the window stops the pipeline
+        preview.on_quit = pipeline.stop_event.set
+        preview.start()
+    pipeline.start()
+    if quality is not None:
+        quality.start()
+    try:
+        while pipeline.is_running():
+            pipeline.stop_event.wait(STATS_INTERVAL)
+            update_gauges(pipeline, scheduler)
+            # Printed every few seconds rather than every frame, because over
+            # SSH the printing itself costs noticeable time
+            print(f"[INFO] fps: {fps:.1f}, {pipeline.format_stats()}")
+            print(f"[INFO] {scheduler.format_metrics()}")
+            print(metrics.format_summary())
+    except KeyboardInterrupt:
+        # Allow script to be stopped with Ctrl+C when running over SSH
+        pass
+
+    if quality is not None:
+        quality.stop()
+    pipeline.stop()
+    if preview is not None:
+        preview.stop()
+    servo.stop()
+    if pool is not None:
+        pool.stop()
+    for exporter in exporters:
+        exporter.stop()
+    if tracer is not None:
+        frames_path = os.path.splitext(args.trace)[0] + ".frames"
+        trace_count, saved_frame_count = tracer.save(args.trace, frames_path if args.trace_frames else None)
+        print(f"[INFO] {trace_count} frame traces saved to '{args.trace}'"
+              + (f", {saved_frame_count} frames to '{frames_path}'" if saved_frame_count else ""))
+    for name, error in pipeline.errors():
+        print(f"[ERROR] {name} stage failed: {error!r}")
+
+    # By stopping the pipeline we run this code here which closes everything
+    frame_source.stop()
+
+if __name__ == "__main__":
+    main()
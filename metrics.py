@@ -0,0 +1,218 @@
+import json
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Prefix of every metric name in the Prometheus export
+PROMETHEUS_PREFIX = "face_tracking_"
+
+
+class Histogram:
+    """
+    A rolling window of the latest `size` samples, for percentiles of what is
+    happening now rather than since startup. The count and sum cover every
+    sample ever observed.
+    """
+
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        samples = np.array(self.samples) if self.samples else np.zeros(1)
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': float(np.mean(samples)),
+            'p50': float(np.percentile(samples, 50)),
+            'p95': float(np.percentile(samples, 95)),
+            'p99': float(np.percentile(samples, 99)),
+            'max': float(np.max(samples)),
+        }
+
+
+class Timer:
+    """
+    Times the block it wraps into a histogram of the same name. The time in
+    milliseconds is left in `ms` for callers that also report it themselves.
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.ms = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.ms = (time.perf_counter() - self._start) * 1000
+        self.metrics.observe(self.name, self.ms)
+        return False
+
+
+class Metrics:
+    """
+    Histograms of timings (in milliseconds), counters and gauges, shared by all
+    the threads of the pipeline. Recording is a dictionary lookup and a deque
+    append, cheap enough to do around every step of every frame.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.window)
+            histogram.observe(value)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def timer(self, name):
+        """
+        Time a block: `with metrics.timer("face_encoding"): ...`
+        """
+        return Timer(self, name)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+    def format_summary(self):
+        """
+        A few lines for the periodic log: the timings, then the counters.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            f"{name}: p50 {s['p50']:.1f} ms, p95 {s['p95']:.1f} ms, max {s['max']:.1f} ms ({s['count']})"
+            for name, s in sorted(snapshot['histograms'].items())
+        ]
+        if snapshot['counters']:
+            lines.append(", ".join(f"{name}: {value}" for name, value in sorted(snapshot['counters'].items())))
+        return "\n".join(lines)
+
+    def to_prometheus(self):
+        """
+        The metrics in the Prometheus text exposition format. Histograms are
+        exported as summaries with their rolling window quantiles.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, s in sorted(snapshot['histograms'].items()):
+            metric = prometheus_name(name) + "_ms"
+            lines.append(f"# TYPE {metric} summary")
+            for key, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                lines.append(f'{metric}{{quantile="{quantile}"}} {s[key]}')
+            lines.append(f"{metric}_sum {s['sum']}")
+            lines.append(f"{metric}_count {s['count']}")
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = prometheus_name(name) + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, value in sorted(snapshot['gauges'].items()):
+            metric = prometheus_name(name)
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def prometheus_name(name):
+    return PROMETHEUS_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+class JsonlExporter:
+    """
+    Appends a snapshot of the metrics to a JSON lines file every `interval` seconds.
+    """
+
+    def __init__(self, metrics, path, interval=5.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-jsonl", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join(timeout=2)
+        self._write()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        snapshot = self.metrics.snapshot()
+        snapshot['timestamp'] = time.time()
+        with open(self.path, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+
+
+class PrometheusExporter:
+    """
+    Serves the metrics for Prometheus to scrape at http://<host>:<port>/metrics.
+    Only this machine can reach it unless `host` is set to an address other
+    machines can reach, such as "0.0.0.0" for every interface.
+    """
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        exporter_metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter_metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes every few seconds would otherwise flood the log
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# The metrics of this process, recorded to from every module
+metrics = Metrics()
@@ -0,0 +1,106 @@
+import cv2
+import numpy as np
+
+
+class MotionTileSelector:
+    """
+    Picks which parts of the frame a full scan needs to look at. The frame is
+    split into a grid of tiles, and a tile is scanned when it has changed since
+    the last scan, when it holds a face that tracking has lost, or when its
+    turn comes in a rolling sweep that makes sure every tile is scanned now and
+    then, so a face that walked in and stood still is found eventually.
+
+    Changes are found by differencing small grayscale copies of the frames,
+    which costs well under a millisecond.
+
+    Args:
+        grid (tuple): Number of (columns, rows) of tiles.
+        overlap (float): How far tiles extend into their neighbours, as a
+            fraction of the tile size, so that a face on a border is seen whole
+            by at least one tile.
+        pixel_threshold (int): Grayscale difference (0 to 255) for a pixel to count as changed.
+        changed_fraction (float): Fraction of a tile's pixels that must change
+            for the tile to be scanned.
+        sweep_tiles (int): Unchanged tiles to scan anyway on each scan.
+        work_size (tuple): Size of the grayscale copies the differencing runs on.
+    """
+
+    def __init__(self, grid=(4, 3), overlap=0.25, pixel_threshold=25, changed_fraction=0.02,
+                 sweep_tiles=1, work_size=(160, 90)):
+        self.grid = grid
+        self.overlap = overlap
+        self.pixel_threshold = pixel_threshold
+        self.changed_fraction = changed_fraction
+        self.sweep_tiles = sweep_tiles
+        self.work_size = work_size
+        self.reference = None
+        self.sweep_position = 0
+
+    def _gray(self, frame):
+        small = cv2.resize(frame, self.work_size, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGRA2GRAY if small.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+        # Blurred so that sensor noise doesn't count as motion
+        return cv2.GaussianBlur(gray, (5, 5), 0)
+
+    def tile_box(self, tile):
+        """
+        The normalized (top, right, bottom, left) box of a (column, row) tile,
+        including its overlap.
+        """
+        columns, rows = self.grid
+        column, row = tile
+        margin_h = self.overlap / columns
+        margin_v = self.overlap / rows
+        return (
+            max(0.0, row / rows - margin_v),
+            min(1.0, (column + 1) / columns + margin_h),
+            min(1.0, (row + 1) / rows + margin_v),
+            max(0.0, column / columns - margin_h),
+        )
+
+    def select(self, frame, lost_face_locations=()):
+        """
+        Choose the tiles to scan in `frame`, and remember the frame as the
+        reference for the next scan. The first frame is scanned whole.
+
+        Args:
+            frame (ndarray): The frame about to be scanned.
+            lost_face_locations (list): Normalized locations of faces tracking
+                has lost, whose tiles are always scanned.
+
+        Returns:
+            list: The (column, row) tiles to scan.
+        """
+        columns, rows = self.grid
+        all_tiles = [(column, row) for row in range(rows) for column in range(columns)]
+        gray = self._gray(frame)
+        reference, self.reference = self.reference, gray
+        if reference is None:
+            return all_tiles
+
+        changed = cv2.absdiff(gray, reference) > self.pixel_threshold
+        height, width = changed.shape
+        selected = set()
+        for column, row in all_tiles:
+            tile = changed[row * height // rows:(row + 1) * height // rows,
+                           column * width // columns:(column + 1) * width // columns]
+            if np.count_nonzero(tile) > self.changed_fraction * tile.size:
+                selected.add((column, row))
+
+        for top, right, bottom, left in lost_face_locations:
+            center_x = min(max((left + right) / 2, 0.0), 0.999)
+            center_y = min(max((top + bottom) / 2, 0.0), 0.999)
+            selected.add((int(center_x * columns), int(center_y * rows)))
+
+        # Top up with the next tiles of the sweep
+        swept = 0
+        for _ in range(len(all_tiles)):
+            if swept >= self.sweep_tiles:
+                break
+            tile = all_tiles[self.sweep_position]
+            self.sweep_position = (self.sweep_position + 1) % len(all_tiles)
+            if tile not in selected:
+                selected.add(tile)
+                swept += 1
+
+        return [tile for tile in all_tiles if tile in selected]
@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import deque
+from metrics import metrics
+
+
+class DropOldestQueue:
+    """
+    A bounded queue that never blocks the producer. When the queue is full the
+    oldest item is discarded to make room, so consumers always see the newest
+    data and never fall behind on a backlog.
+    """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._condition = threading.Condition()
+        self.put_count = 0
+        self.drop_count = 0
+
+    def put(self, item):
+        with self._condition:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.drop_count += 1
+            self._items.append(item)
+            self.put_count += 1
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest item, waiting up to `timeout` seconds.
+        Returns None if nothing arrived in time.
+        """
+        with self._condition:
+            if not self._items:
+                self._condition.wait(timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def depth(self):
+        with self._condition:
+            return len(self._items)
+
+
+class Stage:
+    """
+    One worker of the pipeline. The stage takes items from `input_queue`, passes
+    them through `func` and puts the result on each of `output_queues`. If `func`
+    returns None the item is dropped. A stage without an input queue is a source
+    and calls `func()` with no arguments in a loop.
+    """
+
+    def __init__(self, name, func, input_queue=None, output_queues=()):
+        self.name = name
+        self.func = func
+        self.input_queue = input_queue
+        self.output_queues = list(output_queues)
+        self.processed_count = 0
+        self.busy_time = 0.0
+        # Every call of `func` is timed into this histogram
+        self.metric_name = f"stage.{name}"
+        self.error = None
+        self._thread = None
+
+    def start(self, stop_event):
+        self._started_at = time.time()
+        self._thread = threading.Thread(target=self._run, args=(stop_event,), name=self.name, daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, stop_event):
+        try:
+            while not stop_event.is_set():
+                if self.input_queue is None:
+                    item_start = time.time()
+                    result = self.func()
+                else:
+                    item = self.input_queue.get(timeout=0.1)
+                    if item is None:
+                        continue
+                    item_start = time.time()
+                    result = self.func(item)
+                item_time = time.time() - item_start
+                self.busy_time += item_time
+                metrics.observe(self.metric_name, item_time * 1000)
+                self.processed_count += 1
+
+                if result is None:
+                    continue
+                for output_queue in self.output_queues:
+                    output_queue.put(result)
+        except Exception as e:
+            # Bring the whole pipeline down rather than leaving a silently dead stage
+            self.error = e
+            stop_event.set()
+            raise
+
+    def stats(self):
+        elapsed = max(time.time() - self._started_at, 1e-9)
+        return {
+            'processed': self.processed_count,
+            'rate': self.processed_count / elapsed,
+            'occupancy': min(1.0, self.busy_time / elapsed),
+            'queue_depth': self.input_queue.depth() if self.input_queue is not None else 0,
+            'queue_dropped': self.input_queue.drop_count if self.input_queue is not None else 0,
+        }
+
+
+class Pipeline:
+    """
+    A chain of stages, each running on its own thread and joined by bounded
+    drop-oldest queues.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.stop_event = threading.Event()
+
+    def add_stage(self, name, func, input_queue=None, output_queues=()):
+        stage = Stage(name, func, input_queue, output_queues)
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start(self.stop_event)
+
+    def stop(self):
+        self.stop_event.set()
+        for stage in self.stages:
+            stage.join(timeout=2)
+
+    def is_running(self):
+        return not self.stop_event.is_set()
+
+    def errors(self):
+        return [(stage.name, stage.error) for stage in self.stages if stage.error is not None]
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def format_stats(self):
+        return ", ".join(
+            f"{name}: {s['rate']:.1f}/s busy {s['occupancy'] * 100:.0f}% q {s['queue_depth']} (dropped {s['queue_dropped']})"
+            for name, s in self.stats().items()
+        )
@@ -0,0 +1,139 @@
+import cv2
+import numpy as np
+
+# Frames are reduced to this size as the first thing after capture, which is
+# the resolution full scans have always detected at
+PROCESSING_SIZE = (960, 540)
+
+
+def adjust_brightness(frame, target_brightness=127):
+    # Calculate current average brightness
+    current_brightness = np.mean(cv2.cvtColor(frame, cv2.COLOR_BGRA2GRAY))
+
+    # Calculate brightness ratio
+    brightness_ratio = target_brightness / current_brightness
+
+    # Adjust brightness while keeping within bounds
+    adjusted = cv2.convertScaleAbs(frame, alpha=brightness_ratio, beta=0)
+    return adjusted
+
+
+def preprocess_frame(frame):
+    # Invert the frame on the y-axis because the camera is upside down
+    frame = cv2.flip(frame, -1)
+
+    # Add brightness adjustment before processing
+    return adjust_brightness(frame)
+
+
+class Preprocessor:
+    """
+    The fused, reduced-resolution version of `preprocess_frame`. The frame is
+    downscaled to `size` first, then flipped and brightness-adjusted in place,
+    so the full-size frame is read exactly once and never copied. Brightness is
+    estimated from a sparse grid of pixels instead of a full grayscale copy.
+
+    Results are written into a ring of `buffer_count` preallocated buffers, so
+    a result stays valid until that many more frames have been processed.
+    Anything that holds on to a frame for longer must copy it.
+
+    Args:
+        size (tuple): (width, height) of the processed frames.
+        target_brightness (int): Mean brightness the gain aims for.
+        brightness_step (int): Sample every this many pixels in each direction
+            of the input frame when estimating brightness.
+        buffer_count (int): Number of output buffers to rotate through.
+    """
+
+    def __init__(self, size=(960, 540), target_brightness=127, brightness_step=16, buffer_count=8):
+        self.size = tuple(size)
+        self.target_brightness = target_brightness
+        self.brightness_step = brightness_step
+        self.buffer_count = buffer_count
+        self.buffers = []
+        self.next_buffer = 0
+        # The gain applied to the last frame, for treating full resolution crops the same way
+        self.brightness_ratio = 1.0
+
+    def estimate_brightness(self, frame):
+        step = self.brightness_step
+        samples = np.ascontiguousarray(frame[::step, ::step])
+        conversion = cv2.COLOR_BGRA2GRAY if samples.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return float(np.mean(cv2.cvtColor(samples, conversion)))
+
+    def _take_buffer(self, channels, dtype):
+        width, height = self.size
+        if not self.buffers or self.buffers[0].shape[2] != channels or self.buffers[0].dtype != dtype:
+            self.buffers = [np.empty((height, width, channels), dtype=dtype) for _ in range(self.buffer_count)]
+            self.next_buffer = 0
+        buffer = self.buffers[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        return buffer
+
+    def process(self, frame):
+        # Flipping doesn't change the brightness, so it can be measured on the original
+        brightness_ratio = self.target_brightness / max(1.0, self.estimate_brightness(frame))
+        self.brightness_ratio = brightness_ratio
+
+        output = self._take_buffer(frame.shape[2], frame.dtype)
+        cv2.resize(frame, self.size, dst=output)
+        # Invert the frame on the y-axis because the camera is upside down
+        cv2.flip(output, -1, dst=output)
+        cv2.convertScaleAbs(output, dst=output, alpha=brightness_ratio, beta=0)
+        return output
+
+
+def crop_full_resolution_faces(frame, face_locations, brightness_ratio=1.0, margin=0.3):
+    """
+    Cut the faces out of an unprocessed full resolution frame, applying the
+    same flip and gain as the preprocessing so they match the processed frames.
+    Only the crops are flipped and converted, never the whole frame.
+
+    Args:
+        frame (ndarray): A full resolution frame straight from the camera.
+        face_locations (list): Normalized face locations in the processed (flipped) frame.
+        brightness_ratio (float): The gain the preprocessing applied.
+        margin (float): How much of the face size to include around each face.
+
+    Returns:
+        tuple: A tuple containing:
+            - crops (list): An RGB image of each face, or None for a face that is out of the frame.
+            - crop_face_locations (list): The face location in pixels of each crop, or None.
+    """
+    frame_height, frame_width = frame.shape[:2]
+    conversion = cv2.COLOR_BGRA2RGB if frame.shape[2] == 4 else cv2.COLOR_BGR2RGB
+    crops = []
+    crop_face_locations = []
+    for (top, right, bottom, left) in face_locations:
+        # The processed frames are rotated by 180 degrees relative to the camera
+        face_top = int((1 - bottom) * frame_height)
+        face_bottom = int((1 - top) * frame_height)
+        face_left = int((1 - right) * frame_width)
+        face_right = int((1 - left) * frame_width)
+
+        margin_v = int((face_bottom - face_top) * margin)
+        margin_h = int((face_right - face_left) * margin)
+        crop_top = max(0, face_top - margin_v)
+        crop_bottom = min(frame_height, face_bottom + margin_v)
+        crop_left = max(0, face_left - margin_h)
+        crop_right = min(frame_width, face_right + margin_h)
+
+        if face_right - face_left < 2 or face_bottom - face_top < 2 or crop_right - crop_left < 2 or crop_bottom - crop_top < 2:
+            # The face has gone out of the frame, so there is nothing to encode
+            crops.append(None)
+            crop_face_locations.append(None)
+            continue
+
+        crop = cv2.flip(frame[crop_top:crop_bottom, crop_left:crop_right], -1)
+        crop = cv2.convertScaleAbs(crop, alpha=brightness_ratio, beta=0)
+        crops.append(cv2.cvtColor(crop, conversion))
+
+        crop_height = crop_bottom - crop_top
+        crop_width = crop_right - crop_left
+        crop_face_locations.append((
+            crop_height - (face_bottom - crop_top),
+            crop_width - (face_left - crop_left),
+            crop_height - (face_top - crop_top),
+            crop_width - (face_right - crop_left),
+        ))
+    return crops, crop_face_locations
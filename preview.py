@@ -0,0 +1,180 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import numpy as np
+
+# Boundary between the JPEG parts of the MJPEG stream
+MJPEG_BOUNDARY = "frame"
+
+
+def draw_results(frame, face_locations, face_names, live):
+    """
+    Draw a box and name for each face, in place. Line widths and text are
+    sized for the frame, so this works as well on a small preview as on a full
+    resolution frame.
+    """
+    frame_width = frame.shape[1]
+    frame_height = frame.shape[0]
+    thickness = max(1, frame_width // 640)
+    font_scale = frame_width / 1920
+
+    for (top, right, bottom, left), name, live in zip(face_locations, face_names, live):
+        # Face locations are normalized, so scale them to this frame
+        top = int(top * frame_height)
+        right = int(right * frame_width)
+        bottom = int(bottom * frame_height)
+        left = int(left * frame_width)
+
+        # If live, use green color, otherwise use red
+        color = (0, 255, 0) if live else (0, 0, 255)
+
+        # Draw a box around the face
+        cv2.rectangle(frame, (left, top), (right, bottom), color, thickness)
+
+        # Draw a label with a name above the face
+        label_height = int(35 * font_scale) + 4
+        cv2.rectangle(frame, (left - 1, top - label_height), (right + 1, top), (244, 42, 3), cv2.FILLED)
+        cv2.putText(frame, name, (left + 2, top - 3), cv2.FONT_HERSHEY_DUPLEX, font_scale, (255, 255, 255), 1)
+
+    return frame
+
+
+class Preview:
+    """
+    Shows what the tracker sees in a window and/or as an MJPEG stream, on its
+    own thread at a low rate so it never holds up tracking.
+
+    `update_frame` is called with every frame but only downscales one into a
+    reused buffer when the next preview is due, and `update_faces` just stores
+    the latest faces. The preview thread draws onto a second reused buffer at
+    the preview size, so nothing is drawn at full resolution.
+
+    Args:
+        size (tuple): (width, height) of the preview.
+        rate (float): Previews per second.
+        window (bool): Show the preview in an OpenCV window.
+        mjpeg_port (int): Serve the preview at http://localhost:<port>/, or None.
+        on_quit: Called when 'q' is pressed in the window.
+    """
+
+    def __init__(self, size=(640, 360), rate=10.0, window=True, mjpeg_port=None, on_quit=None):
+        self.size = size
+        self.rate = rate
+        self.window = window
+        self.on_quit = on_quit
+        self.frame_buffer = None
+        self.draw_buffer = None
+        self.faces = ([], [], [])
+        self.fps = 0.0
+        self.lock = threading.Lock()
+        self.next_frame_time = 0.0
+        self.frame_ready = False
+        self.jpeg = None
+        self.jpeg_condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="preview", daemon=True)
+        self.server = None
+        if mjpeg_port is not None:
+            self.server = ThreadingHTTPServer(("127.0.0.1", mjpeg_port), self._make_handler())
+            self._server_thread = threading.Thread(target=self.server.serve_forever, name="preview-http", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        if self.server is not None:
+            self._server_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        with self.jpeg_condition:
+            self.jpeg_condition.notify_all()
+        self._thread.join(timeout=2)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def update_frame(self, frame, fps=0.0):
+        """
+        Offer a frame for the preview. Cheap unless a preview is due.
+        """
+        now = time.time()
+        if now < self.next_frame_time:
+            return
+        self.next_frame_time = now + 1 / self.rate
+        with self.lock:
+            if self.frame_buffer is None or self.frame_buffer.shape[2] != frame.shape[2]:
+                width, height = self.size
+                self.frame_buffer = np.empty((height, width, frame.shape[2]), dtype=frame.dtype)
+            cv2.resize(frame, self.size, dst=self.frame_buffer, interpolation=cv2.INTER_AREA)
+            self.fps = fps
+            self.frame_ready = True
+
+    def update_faces(self, face_locations, face_names, live):
+        with self.lock:
+            self.faces = (list(face_locations), list(face_names), list(live))
+
+    def _run(self):
+        while not self._stop_event.wait(1 / self.rate):
+            with self.lock:
+                if not self.frame_ready:
+                    continue
+                self.frame_ready = False
+                # Drawn on a copy so the next frame can be taken meanwhile
+                if self.draw_buffer is None or self.draw_buffer.shape != self.frame_buffer.shape:
+                    self.draw_buffer = np.empty_like(self.frame_buffer)
+                np.copyto(self.draw_buffer, self.frame_buffer)
+                face_locations, face_names, live = self.faces
+                fps = self.fps
+
+            draw_results(self.draw_buffer, face_locations, face_names, live)
+            # Attach FPS counter to the text and boxes
+            cv2.putText(self.draw_buffer, f"FPS: {fps:.1f}", (self.draw_buffer.shape[1] - 150, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+
+            if self.server is not None:
+                image = self.draw_buffer[:, :, :3] if self.draw_buffer.shape[2] == 4 else self.draw_buffer
+                encoded, jpeg = cv2.imencode(".jpg", np.ascontiguousarray(image), [cv2.IMWRITE_JPEG_QUALITY, 70])
+                if encoded:
+                    with self.jpeg_condition:
+                        self.jpeg = jpeg.tobytes()
+                        self.jpeg_condition.notify_all()
+
+            if self.window:
+                cv2.imshow('Video', self.draw_buffer)
+                # Quit if 'q' is pressed
+                if cv2.waitKey(1) == ord("q") and self.on_quit is not None:
+                    self.on_quit()
+
+        if self.window:
+            cv2.destroyAllWindows()
+
+    def _make_handler(self):
+        preview = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}")
+                self.end_headers()
+                last = None
+                try:
+                    while not preview._stop_event.is_set():
+                        with preview.jpeg_condition:
+                            preview.jpeg_condition.wait_for(
+                                lambda: preview.jpeg is not last or preview._stop_event.is_set(), timeout=1.0)
+                            jpeg = preview.jpeg
+                        if jpeg is None or jpeg is last:
+                            continue
+                        last = jpeg
+                        self.wfile.write(f"--{MJPEG_BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                                         f"Content-Length: {len(jpeg)}\r\n\r\n".encode("ascii"))
+                        self.wfile.write(jpeg)
+                        self.wfile.write(b"\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The viewer went away
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,163 @@
+import threading
+import time
+from metrics import metrics
+
+# Quality levels from best to cheapest. Each level sets every knob at once, so
+# a change is one step the log can explain. Level 0 is what the stand does
+# without the controller.
+#   full_scan_scale: scale the processed frame is scanned at in full scans
+#   crop_width, margin: delta scan crops of faces that were found last time
+#   lost_crop_width, lost_margin: delta scan crops of faces that were lost
+#   redetect_interval: frames a tracked face is followed by correlation alone
+#   cpu_budget, max_interval, failure_scale: see `FullScanScheduler`
+QUALITY_LEVELS = [
+    {'full_scan_scale': 1.0, 'crop_width': 50, 'margin': 0.3, 'lost_crop_width': 150, 'lost_margin': 1.0,
+     'redetect_interval': 15, 'cpu_budget': 0.25, 'max_interval': 20.0, 'failure_scale': 10},
+    {'full_scan_scale': 1.0, 'crop_width': 46, 'margin': 0.25, 'lost_crop_width': 130, 'lost_margin': 0.8,
+     'redetect_interval': 25, 'cpu_budget': 0.2, 'max_interval': 20.0, 'failure_scale': 10},
+    {'full_scan_scale': 0.75, 'crop_width': 42, 'margin': 0.2, 'lost_crop_width': 110, 'lost_margin': 0.7,
+     'redetect_interval': 35, 'cpu_budget': 0.15, 'max_interval': 30.0, 'failure_scale': 15},
+    {'full_scan_scale': 0.5, 'crop_width': 40, 'margin': 0.2, 'lost_crop_width': 100, 'lost_margin': 0.6,
+     'redetect_interval': 50, 'cpu_budget': 0.1, 'max_interval': 30.0, 'failure_scale': 20},
+]
+
+# The settings of a level that go to `find_faces.delta_scan`
+DELTA_SCAN_SETTINGS = ('crop_width', 'margin', 'lost_crop_width', 'lost_margin')
+
+
+class QualityController:
+    """
+    Holds the frame rate (or latency) steady as the scene gets busier by
+    trading detection quality for time. Every `interval` seconds it compares
+    the frames the detect stage got through, and how long each took, with the
+    target, and moves one step along `QUALITY_LEVELS`:
+
+    - down (cheaper) as soon as the target is missed,
+    - up (better) once there has been headroom for `hold` intervals in a row,
+      or for a single interval when tracks keep being lost, since that is
+      what the cheaper settings cost.
+
+    The detect and full scan stages read the current level from `settings`,
+    and the scheduler and tracker knobs are set through `apply`.
+
+    Args:
+        target_fps (float): Frame rate to hold.
+        latency_budget (float): Mean capture to servo time to stay under, in
+            milliseconds, or None.
+        apply: Called with the settings of each new level.
+        interval (float): Seconds between decisions.
+        headroom (float): Fraction of the frame time the detect stage may take
+            before quality can go up.
+        hold (int): Good intervals before quality goes up.
+        max_failure_rate (float): Fraction of failed delta scans above which
+            tracks count as being lost.
+    """
+
+    def __init__(self, target_fps=15.0, latency_budget=None, apply=None, interval=2.0, headroom=0.6, hold=3,
+                 max_failure_rate=0.3, levels=QUALITY_LEVELS):
+        self.target_fps = target_fps
+        self.latency_budget = latency_budget
+        self.apply = apply
+        self.interval = interval
+        self.headroom = headroom
+        self.hold = hold
+        self.max_failure_rate = max_failure_rate
+        self.levels = levels
+        self.level = 0
+        self.settings = levels[0]
+        self.good_intervals = 0
+        self.last_decision = None
+        self._last = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="quality", daemon=True)
+
+    def start(self):
+        if self.apply is not None:
+            self.apply(self.settings)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join(timeout=2)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.update()
+
+    def _measure(self):
+        # Totals from the metrics, turned into rates over the last interval
+        snapshot = metrics.snapshot()
+        detect = snapshot['histograms'].get('stage.detect', {})
+        latency = snapshot['histograms'].get('photon_to_servo', {})
+        totals = {
+            'time': time.time(),
+            'frames': detect.get('count', 0),
+            'detect_ms': detect.get('sum', 0.0),
+            'latency_count': latency.get('count', 0),
+            'latency_ms': latency.get('sum', 0.0),
+            'delta_scans': snapshot['counters'].get('delta_scan.faces', 0),
+            'delta_failed': snapshot['counters'].get('delta_scan.failed', 0),
+        }
+        last, self._last = self._last, totals
+        if last is None:
+            return None
+        frames = totals['frames'] - last['frames']
+        latency_count = totals['latency_count'] - last['latency_count']
+        delta_scans = totals['delta_scans'] - last['delta_scans']
+        return {
+            'fps': frames / max(totals['time'] - last['time'], 1e-9),
+            'detect_ms': (totals['detect_ms'] - last['detect_ms']) / frames if frames else 0.0,
+            'latency_ms': (totals['latency_ms'] - last['latency_ms']) / latency_count if latency_count else 0.0,
+            'failure_rate': (totals['delta_failed'] - last['delta_failed']) / delta_scans if delta_scans else 0.0,
+        }
+
+    def update(self):
+        """
+        Measure the last interval and change level if needed. Returns the
+        measurements, or None on the first call.
+        """
+        measured = self._measure()
+        if measured is None:
+            return None
+        frame_budget_ms = 1000 / self.target_fps
+        fps, detect_ms = measured['fps'], measured['detect_ms']
+
+        if fps < 0.9 * self.target_fps and detect_ms > 0.9 * frame_budget_ms:
+            # Missing the target because detection is too slow, rather than
+            # because the camera delivers fewer frames
+            self._step(1, f"{fps:.1f} fps below the target of {self.target_fps:.0f} "
+                          f"(detect {detect_ms:.0f} ms per frame)", measured)
+        elif self.latency_budget is not None and measured['latency_ms'] > self.latency_budget:
+            self._step(1, f"latency {measured['latency_ms']:.0f} ms over the budget of {self.latency_budget:.0f} ms",
+                       measured)
+        else:
+            losing_tracks = measured['failure_rate'] > self.max_failure_rate
+            limit = 0.9 if losing_tracks else self.headroom
+            if detect_ms < limit * frame_budget_ms:
+                self.good_intervals += 1
+                if self.good_intervals >= (1 if losing_tracks else self.hold):
+                    reason = (f"{measured['failure_rate'] * 100:.0f}% of delta scans failing" if losing_tracks
+                              else f"detect {detect_ms:.0f} ms of a {frame_budget_ms:.0f} ms frame")
+                    self._step(-1, reason, measured)
+            else:
+                self.good_intervals = 0
+
+        metrics.set_gauge("quality.level", self.level)
+        return measured
+
+    def _step(self, direction, reason, measured):
+        self.good_intervals = 0
+        level = min(len(self.levels) - 1, max(0, self.level + direction))
+        if level == self.level:
+            return
+        print(f"[INFO] quality level {self.level} -> {level}: {reason}")
+        self.level = level
+        self.settings = self.levels[level]
+        self.last_decision = reason
+        metrics.count("quality.changes")
+        if self.apply is not None:
+            self.apply(self.settings)
+
+    def delta_scan_settings(self):
+        settings = self.settings
+        return {key: settings[key] for key in DELTA_SCAN_SETTINGS}
@@ -0,0 +1,100 @@
+import time
+import cv2
+import numpy as np
+
+
+class FullScanScheduler:
+    """
+    Decides when to run a full scan. Instead of a fixed timer, full scans get a
+    share of the CPU: with full scans costing `cost` seconds, they run at most
+    every `cost / cpu_budget` seconds. Within that limit the interval shrinks
+    towards the minimum when faces are being lost or the scene is moving, and
+    grows towards `max_interval` when tracking is going well in a still scene.
+
+    Args:
+        cpu_budget (float): Fraction of the time full scans may take up.
+        max_interval (float): Longest time between full scans, in seconds.
+        motion_scale (float): Mean frame difference (0 to 1.0) that counts as
+            a fully moving scene.
+        failure_scale (int): Consecutive frames with lost tracks that count as
+            fully lost.
+    """
+
+    def __init__(self, cpu_budget=0.25, max_interval=20.0, motion_scale=0.05, failure_scale=10):
+        self.cpu_budget = cpu_budget
+        self.max_interval = max_interval
+        self.motion_scale = motion_scale
+        self.failure_scale = failure_scale
+        # Running average of how long a full scan takes, updated as scans finish
+        self.scan_cost = 0.5
+        self.last_scan_time = None
+        self.scan_in_progress = False
+        self.scan_count = 0
+        self.started_at = time.time()
+        self.motion = 0.0
+        self.urgency = 1.0
+        self.interval = 0.0
+        self.reason = None
+        self.last_scan_reason = None
+        self._thumbnail = None
+
+    def observe(self, frame):
+        """
+        Measure scene motion as the mean difference between tiny grayscale
+        copies of consecutive frames.
+        """
+        small = cv2.resize(frame, (32, 18), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGRA2GRAY if small.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+        thumbnail = small.astype(np.float32) / 255
+        if self._thumbnail is not None:
+            self.motion = float(np.mean(np.abs(thumbnail - self._thumbnail)))
+        self._thumbnail = thumbnail
+
+    def should_scan(self, now, track_count, live_count, failed_delta_count):
+        """
+        Whether to start a full scan now. The reason is left in `reason`.
+        """
+        if track_count == 0:
+            self.urgency, self.reason = 1.0, "no faces tracked"
+        else:
+            candidates = [
+                (1 - live_count / track_count, "tracks lost"),
+                (min(1.0, failed_delta_count / self.failure_scale), "repeated failed delta scans"),
+                (min(1.0, self.motion / self.motion_scale), "scene motion"),
+            ]
+            self.urgency, self.reason = max(candidates)
+            if self.urgency == 0:
+                self.reason = "interval elapsed"
+
+        min_interval = self.scan_cost / self.cpu_budget
+        self.interval = max(min_interval, self.max_interval - (self.max_interval - min_interval) * self.urgency)
+
+        if self.scan_in_progress:
+            return False
+        return self.last_scan_time is None or now - self.last_scan_time >= self.interval
+
+    def scan_started(self, now):
+        self.scan_in_progress = True
+        self.last_scan_time = now
+        self.last_scan_reason = self.reason
+        self.scan_count += 1
+
+    def scan_finished(self, duration):
+        self.scan_in_progress = False
+        self.scan_cost = 0.8 * self.scan_cost + 0.2 * duration
+
+    def metrics(self):
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        return {
+            'interval': self.interval,
+            'urgency': self.urgency,
+            'motion': self.motion,
+            'scan_cost': self.scan_cost,
+            'scans_per_minute': self.scan_count / elapsed * 60,
+        }
+
+    def format_metrics(self):
+        m = self.metrics()
+        return (f"full scan every {m['interval']:.1f} s (urgency {m['urgency']:.2f}, motion {m['motion']:.3f}, "
+                f"cost {m['scan_cost'] * 1000:.0f} ms, {m['scans_per_minute']:.1f}/min, last for {self.last_scan_reason})")
@@ -1,14 +1,203 @@
+import bisect
+import threading
+import time
+from collections import deque
+from metrics import metrics
 
-from adafruit_servokit import ServoKit
+# The servo HAT is opened on first use rather than on import, so that code
+# importing this module doesn't need the hardware. See `get_servo_kit`.
+_kit = None
+_kit_lock = threading.Lock()
 
-print("[INFO] initializing servo...")
-kit = ServoKit(channels=16)
+def get_servo_kit():
+    """
+    The ServoKit driving the servo HAT, opened over I2C on first use.
+    """
+    global _kit
+    with _kit_lock:
+        if _kit is None:
+            from adafruit_servokit import ServoKit
+
+            print("[INFO] initializing servo...")
+            _kit = ServoKit(channels=16)
+        return _kit
 
 def servo_control(face_locations):
-    # Move the servo to the average x-position of the faces
+    """
+    Move the servo to the average x-position of the faces. Returns the angle
+    the servo was sent to, or None if there were no faces.
+    """
     if face_locations:
         avg_x = sum([(left + right) / 2 for (top, right, bottom, left) in face_locations]) / len(face_locations)
         # Map x-position to servo angle (0-180)
         servo_angle = avg_x * 180
         # Move servo to the angle
-        kit.servo[0].angle = servo_angle
\ No newline at end of file
+        get_servo_kit().servo[0].angle = servo_angle
+        return servo_angle
+    return None
+
+
+class SimulatedServo:
+    """
+    Stands in for one servo of a ServoKit, recording what is written to it.
+    """
+
+    def __init__(self):
+        self._angle = None
+        self.writes = []
+
+    @property
+    def angle(self):
+        return self._angle
+
+    @angle.setter
+    def angle(self, value):
+        self._angle = value
+        self.writes.append((time.time(), value))
+
+
+class SimulatedServoKit:
+    """
+    A ServoKit without the hardware, for running and testing the servo control
+    off the stand. Has the same `servo[channel].angle` interface.
+    """
+
+    def __init__(self, channels=16):
+        self.servo = [SimulatedServo() for _ in range(channels)]
+
+
+class ServoController:
+    """
+    Drives the servo from its own thread at a fixed rate, independent of how
+    fast faces are detected. Detection only sets the target; the servo follows
+    it like a critically damped spring, which smooths out detection noise
+    without overshooting, and is limited to `max_speed`.
+
+    The target is extrapolated from the detection's timestamp to now using the
+    face's velocity, to make up for the time detection took. The servo is only
+    written when the angle has moved by more than `deadband`, so a still face
+    costs no I2C traffic.
+
+    Args:
+        kit: The ServoKit (or `SimulatedServoKit`) to drive. Defaults to the
+            servo HAT, opened by `start`.
+        channel (int): The servo's channel on the kit.
+        rate (float): Control loop updates per second.
+        smoothing_time (float): Time for the servo to mostly settle on a new
+            target, in seconds.
+        max_speed (float): Slew rate limit, in degrees per second.
+        deadband (float): Smallest change of angle worth writing, in degrees.
+        max_extrapolation (float): Longest time to extrapolate a target over,
+            in seconds, so a stale target doesn't run away.
+    """
+
+    def __init__(self, kit=None, channel=0, rate=50.0, smoothing_time=0.2, max_speed=120.0, deadband=0.5,
+                 max_extrapolation=0.5):
+        self.kit = kit
+        self.channel = channel
+        self.rate = rate
+        self.smoothing_time = smoothing_time
+        self.max_speed = max_speed
+        self.deadband = deadband
+        self.max_extrapolation = max_extrapolation
+        self.lock = threading.Lock()
+        self.target = None
+        self.angle = None
+        self.velocity = 0.0
+        self.written_angle = None
+        self.write_count = 0
+        # Recent (time, angle) of the servo, to look up where the camera was
+        # pointing when a frame was captured
+        self.history = deque(maxlen=500)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def set_target(self, angle, velocity=0.0, timestamp=None):
+        """
+        Aim the servo at `angle` degrees, as seen at `timestamp` and moving at
+        `velocity` degrees per second.
+        """
+        with self.lock:
+            self.target = (angle, velocity, time.time() if timestamp is None else timestamp)
+
+    def start(self):
+        # Opened here rather than on the controller's thread, so that a
+        # missing HAT or library fails the caller instead of silently
+        # killing the thread
+        if self.kit is None:
+            self.kit = get_servo_kit()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="servo", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        period = 1 / self.rate
+        next_time = time.time()
+        while not self._stop_event.is_set():
+            self.step(period)
+            next_time += period
+            self._stop_event.wait(max(0.0, next_time - time.time()))
+
+    def target_angle(self, now):
+        with self.lock:
+            if self.target is None:
+                return None
+            angle, velocity, timestamp = self.target
+        age = min(max(0.0, now - timestamp), self.max_extrapolation)
+        return min(180.0, max(0.0, angle + velocity * age))
+
+    def angle_at(self, timestamp):
+        """
+        The angle the servo was commanded to at `timestamp`, interpolated
+        between control steps, or None before the servo has been moved.
+        """
+        with self.lock:
+            history = list(self.history)
+        if not history:
+            return None
+        times = [t for t, _ in history]
+        i = bisect.bisect_left(times, timestamp)
+        if i == 0:
+            return history[0][1]
+        if i == len(history):
+            return history[-1][1]
+        (time_before, angle_before), (time_after, angle_after) = history[i - 1], history[i]
+        return angle_before + (angle_after - angle_before) * (timestamp - time_before) / (time_after - time_before)
+
+    def step(self, dt, now=None):
+        """
+        Advance the servo by one control period of `dt` seconds.
+        """
+        now = time.time() if now is None else now
+        target = self.target_angle(now)
+        if target is None:
+            return
+        if self.angle is None:
+            # Nothing is known about where the servo is, so go straight there
+            self.angle = target
+        else:
+            # Critically damped spring towards the target
+            omega = 2 / self.smoothing_time
+            acceleration = omega ** 2 * (target - self.angle) - 2 * omega * self.velocity
+            self.velocity = min(self.max_speed, max(-self.max_speed, self.velocity + acceleration * dt))
+            self.angle = min(180.0, max(0.0, self.angle + self.velocity * dt))
+        with self.lock:
+            self.history.append((now, self.angle))
+
+        if self.written_angle is None or abs(self.angle - self.written_angle) >= self.deadband:
+            self.kit.servo[self.channel].angle = self.angle
+            self.written_angle = self.angle
+            self.write_count += 1
+            metrics.count("servo.writes")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,69 @@
+import numpy as np
+from servo_control import ServoController, SimulatedServoKit
+from tracker import Tracker
+from world_frame import CameraPanModel, CAMERA_FIELD_OF_VIEW
+
+FRAME_RATE = 30.0
+FACE_LOCATION = (0.4, 0.55, 0.6, 0.45)
+
+
+def make_frame():
+    # A still scene with a textured "face" the tracker can correlate on
+    rng = np.random.default_rng(0)
+    frame = np.full((540, 960, 4), 90, dtype=np.uint8)
+    top, right, bottom, left = FACE_LOCATION
+    face = rng.integers(0, 255, size=(int((bottom - top) * 540), int((right - left) * 960), 1), dtype=np.uint8)
+    frame[int(top * 540):int(top * 540) + face.shape[0], int(left * 960):int(left * 960) + face.shape[1]] = face
+    return frame
+
+
+def replay(pan_model, servo, frame, frames=90):
+    # The detect and actuate stages of main.py, on a replay of a still frame,
+    # with the servo made to swing widely. Returns the tracker and the furthest
+    # the pan compensation moved the track off the face.
+    tracker = Tracker()
+    tracker.merge(frame, [FACE_LOCATION], 0.0)
+    tracker.update(frame, 0.0)
+    face_x = (FACE_LOCATION[1] + FACE_LOCATION[3]) / 2
+    drift = 0.0
+    for i in range(1, frames):
+        now = i / FRAME_RATE
+        # The servo moves on its own thread between frames
+        servo.step(1 / FRAME_RATE, now)
+        tracker.pan(pan_model.image_shift(tracker.timestamp, now))
+        drift = max(drift, abs(tracker.tracks[0].state[0] - face_x))
+        to_redetect = tracker.update(frame, now)
+        for track in to_redetect:
+            # The face is where a delta scan would find it, if it looks there
+            if abs(track.state[0] - face_x) < 0.1:
+                tracker.correct(track, FACE_LOCATION)
+            else:
+                tracker.miss(track)
+        top, right, bottom, left = tracker.face_locations()[0]
+        swing = 60.0 if (i // 15) % 2 else -60.0
+        servo.set_target(pan_model.image_to_pan((left + right) / 2, now) + swing, 0.0, now)
+    return tracker, drift
+
+
+def test_replay_with_simulated_servo_does_not_drift():
+    servo = ServoController(kit=SimulatedServoKit())
+    tracker, drift = replay(CameraPanModel(servo, camera_moves=False), servo, make_frame())
+
+    # The servo really did swing, but the track stayed on the face
+    assert servo.write_count > 10
+    assert drift < 0.01
+    assert tracker.live() == [True]
+
+
+def test_moving_camera_shifts_by_the_panned_angle():
+    servo = ServoController(kit=SimulatedServoKit())
+    pan_model = CameraPanModel(servo)
+    servo.set_target(90.0, 0.0, 0.0)
+    servo.step(0.02, now=0.0)
+    servo.set_target(100.0, 0.0, 1.0)
+    for i in range(1, 51):
+        servo.step(0.02, now=1.0 + i * 0.02)
+
+    panned = servo.angle_at(2.0) - servo.angle_at(0.0)
+    assert panned > 5
+    assert np.isclose(pan_model.image_shift(0.0, 2.0), -panned / CAMERA_FIELD_OF_VIEW)
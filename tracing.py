@@ -0,0 +1,166 @@
+import argparse
+import cProfile
+import json
+import pstats
+import threading
+from collections import deque
+from frame_source import FrameDumpSource, FrameDumpWriter
+from preprocess import Preprocessor, PROCESSING_SIZE
+
+
+class Tracer:
+    """
+    Records what happened to each frame on its way through the pipeline: when
+    each stage started and finished with it, whether a full scan was started
+    and why, which tracks were re-detected and where the servo was sent.
+
+    Only the latest `capacity` frames are kept, so tracing can be left on. With
+    `frame_capacity` set the latest frames themselves are kept too, as the
+    camera delivered them before preprocessing, so a slow stretch can be
+    replayed with `profile_replay`, or the dump run through main.py or
+    analyze.py like any other recording.
+    """
+
+    def __init__(self, capacity=1000, frame_capacity=0):
+        self.traces = deque(maxlen=capacity)
+        self.frames = deque(maxlen=frame_capacity) if frame_capacity > 0 else None
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    def begin(self, capture_time):
+        """
+        Start the trace of a newly captured frame. The returned dict travels
+        with the frame and is filled in as it goes.
+        """
+        with self.lock:
+            trace = {'frame': self.next_id, 'capture_time': capture_time, 'stages': {}}
+            self.next_id += 1
+            self.traces.append(trace)
+        return trace
+
+    def record_stage(self, trace, name, start, end):
+        trace['stages'][name] = [start, end]
+
+    def capture_frame(self, trace, frame):
+        if self.frames is not None:
+            self.frames.append((trace['frame'], frame.copy()))
+
+    def save(self, path, frames_path=None):
+        """
+        Write the kept traces to `path` as JSON lines, and the kept frames to
+        the frame dump `frames_path`. Traces of frames that were kept get a
+        `frame_index` into the dump.
+        """
+        with self.lock:
+            traces = list(self.traces)
+            frames = list(self.frames) if self.frames is not None else []
+
+        frame_indexes = {}
+        if frames_path is not None and frames:
+            with FrameDumpWriter(frames_path) as writer:
+                for frame_id, frame in frames:
+                    frame_indexes[frame_id] = writer.count
+                    writer.write(frame)
+
+        with open(path, "w") as f:
+            for trace in traces:
+                if trace['frame'] in frame_indexes:
+                    trace = dict(trace, frame_index=frame_indexes[trace['frame']])
+                f.write(json.dumps(trace) + "\n")
+        return len(traces), len(frame_indexes)
+
+
+def load_traces(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def to_chrome_trace(traces):
+    """
+    Convert traces to the Chrome trace event format, to be opened in
+    chrome://tracing or https://ui.perfetto.dev. Each stage gets its own row,
+    with a span for every frame it handled, and full scan decisions are marked
+    on the detect row.
+    """
+    if not traces:
+        return {'traceEvents': []}
+    origin = min(trace['capture_time'] for trace in traces)
+    thread_ids = {}
+    events = []
+
+    def microseconds(timestamp):
+        return (timestamp - origin) * 1e6
+
+    for trace in traces:
+        args = {key: value for key, value in trace.items() if key not in ('stages', 'capture_time')}
+        for name, (start, end) in trace['stages'].items():
+            thread_id = thread_ids.setdefault(name, len(thread_ids) + 1)
+            events.append({
+                'name': f"{name} #{trace['frame']}", 'cat': name, 'ph': 'X', 'pid': 1, 'tid': thread_id,
+                'ts': microseconds(start), 'dur': microseconds(end) - microseconds(start), 'args': args,
+            })
+        if trace.get('full_scan_reason') and 'detect' in trace['stages']:
+            events.append({
+                'name': f"full scan: {trace['full_scan_reason']}", 'ph': 'i', 's': 't', 'pid': 1,
+                'tid': thread_ids['detect'], 'ts': microseconds(trace['stages']['detect'][1]),
+            })
+
+    for name, thread_id in thread_ids.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread_id, 'args': {'name': name}})
+    return {'traceEvents': events}
+
+
+def profile_replay(traces, frames_path, first=None, last=None, sort="cumulative", limit=30):
+    """
+    Run the detection work of frames `first` to `last` again, on the frames kept
+    in the dump, under cProfile: the delta scan of the tracks that were
+    re-detected, and the full scan if one was started on the frame. The kept
+    frames are raw, so they are preprocessed first, outside the profile.
+    """
+    # Imported here so converting traces doesn't need the detector and its models
+    import find_faces
+
+    source = FrameDumpSource(frames_path)
+    source.start()
+    window = [
+        trace for trace in traces
+        if 'frame_index' in trace
+        and (first is None or trace['frame'] >= first)
+        and (last is None or trace['frame'] <= last)
+    ]
+    print(f"[INFO] replaying {len(window)} frames...")
+
+    preprocessor = Preprocessor(size=PROCESSING_SIZE)
+    profiler = cProfile.Profile()
+    for trace in window:
+        frame = preprocessor.process(source.frames[trace['frame_index']])
+        redetect_locations = trace.get('redetect_locations', [])
+        profiler.enable()
+        if redetect_locations:
+            find_faces.delta_scan(frame, redetect_locations, ["Unknown"] * len(redetect_locations), trace['redetect_live'])
+        if trace.get('full_scan_reason'):
+            find_faces.locate_faces(frame, scale=1.0)
+        profiler.disable()
+    source.stop()
+
+    pstats.Stats(profiler).sort_stats(sort).print_stats(limit)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert or replay a trace written by main.py --trace")
+    parser.add_argument("trace_path")
+    parser.add_argument("--chrome", metavar="PATH", help="write the trace in Chrome trace event format")
+    parser.add_argument("--profile", metavar="FRAMES_PATH",
+                        help="replay the detection work on the traced frames in this dump under cProfile")
+    parser.add_argument("--first", type=int, help="first frame number to replay")
+    parser.add_argument("--last", type=int, help="last frame number to replay")
+    args = parser.parse_args()
+
+    traces = load_traces(args.trace_path)
+    print(f"[INFO] loaded {len(traces)} frame traces")
+    if args.chrome:
+        with open(args.chrome, "w") as f:
+            json.dump(to_chrome_trace(traces), f)
+        print(f"[INFO] Chrome trace saved to '{args.chrome}'")
+    if args.profile:
+        profile_replay(traces, args.profile, args.first, args.last)
@@ -0,0 +1,287 @@
+import cv2
+import numpy as np
+
+# Kalman filter tuning, in normalized image units (0 to 1.0) and seconds
+PROCESS_NOISE = 1.0  # How quickly a face can change velocity
+DETECTION_NOISE = 0.01 ** 2  # Variance of a detector measurement
+CORRELATION_NOISE = 0.02 ** 2  # Variance of a correlation measurement
+
+
+def box_iou(a, b):
+    """
+    Intersection over union of two (top, right, bottom, left) boxes.
+    """
+    top = max(a[0], b[0])
+    right = min(a[1], b[1])
+    bottom = min(a[2], b[2])
+    left = max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class Track:
+    """
+    One tracked face with a stable ID. The face center follows a constant
+    velocity Kalman filter and the box size is taken from the last detection.
+    """
+
+    def __init__(self, track_id, face_location, name, timestamp):
+        top, right, bottom, left = face_location
+        self.id = track_id
+        self.name = name
+        self.live = True
+        self.confidence = 1.0
+        self.frames_since_detection = 0
+        # Delta scans in a row that haven't found the face
+        self.misses = 0
+        self.timestamp = timestamp
+        self.width = right - left
+        self.height = bottom - top
+        # State is [center x, center y, velocity x, velocity y]
+        self.state = np.array([(left + right) / 2, (top + bottom) / 2, 0.0, 0.0])
+        self.covariance = np.diag([DETECTION_NOISE, DETECTION_NOISE, 1.0, 1.0])
+        self.template = None
+
+    @property
+    def face_location(self):
+        center_x, center_y = self.state[:2]
+        return (
+            center_y - self.height / 2,
+            center_x + self.width / 2,
+            center_y + self.height / 2,
+            center_x - self.width / 2,
+        )
+
+    def in_frame(self):
+        # Whether any of the box is still inside the frame
+        top, right, bottom, left = self.face_location
+        return right > 0 and left < 1 and bottom > 0 and top < 1
+
+    def predict(self, timestamp):
+        dt = max(0.0, timestamp - self.timestamp)
+        self.timestamp = timestamp
+        transition = np.eye(4)
+        transition[0, 2] = transition[1, 3] = dt
+        # Noise of a random acceleration over the time step
+        noise = PROCESS_NOISE * np.array([
+            [dt ** 4 / 4, 0, dt ** 3 / 2, 0],
+            [0, dt ** 4 / 4, 0, dt ** 3 / 2],
+            [dt ** 3 / 2, 0, dt ** 2, 0],
+            [0, dt ** 3 / 2, 0, dt ** 2],
+        ])
+        self.state = transition @ self.state
+        self.covariance = transition @ self.covariance @ transition.T + noise
+
+    def correct(self, center, variance):
+        measurement = np.eye(2, 4)
+        residual = np.asarray(center) - measurement @ self.state
+        innovation = measurement @ self.covariance @ measurement.T + np.eye(2) * variance
+        gain = self.covariance @ measurement.T @ np.linalg.inv(innovation)
+        self.state = self.state + gain @ residual
+        self.covariance = (np.eye(4) - gain @ measurement) @ self.covariance
+
+
+class Tracker:
+    """
+    Keeps faces tracked between full scans without running the face detector on
+    every frame. Each frame the tracks are moved to their predicted position and
+    refined by correlating a template of the face with the predicted region.
+    Only the tracks whose correlation is poor, or that haven't been checked by
+    the detector for a while, are handed back for re-detection.
+
+    Args:
+        redetect_threshold (float): Correlation score below which a track is re-detected.
+        redetect_interval (int): Frames after which a track is re-detected anyway,
+            so the template can't slowly drift off the face.
+        work_width (int): Width of the grayscale image the correlation runs on.
+        max_misses (int): Delta scans in a row that may miss a face before its
+            track is dropped.
+    """
+
+    def __init__(self, redetect_threshold=0.6, redetect_interval=15, work_width=480, max_misses=5):
+        self.redetect_threshold = redetect_threshold
+        self.redetect_interval = redetect_interval
+        self.work_width = work_width
+        self.max_misses = max_misses
+        self.tracks = []
+        self.next_id = 1
+        self.gray = None
+        # Capture time of the last frame the tracks were moved to
+        self.timestamp = None
+
+    def _grayscale(self, frame):
+        # All correlation work happens on one small grayscale copy of the frame
+        scale = self.work_width / frame.shape[1]
+        small = cv2.resize(frame, (self.work_width, int(frame.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGRA2GRAY if small.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+
+    def _prepare(self, frame):
+        self.gray = self._grayscale(frame)
+
+    def _pixels(self, face_location, margin=0.0, gray=None):
+        # Normalized box, grown by `margin` of its size, to pixels of the small frame
+        height, width = (self.gray if gray is None else gray).shape
+        top, right, bottom, left = face_location
+        margin_v = (bottom - top) * margin
+        margin_h = (right - left) * margin
+        return (
+            max(0, int((top - margin_v) * height)),
+            min(width, int((right + margin_h) * width)),
+            min(height, int((bottom + margin_v) * height)),
+            max(0, int((left - margin_h) * width)),
+        )
+
+    def _take_template(self, track, gray=None):
+        # From the latest tracked frame unless another frame is given
+        gray = self.gray if gray is None else gray
+        top, right, bottom, left = self._pixels(track.face_location, gray=gray)
+        template = gray[top:bottom, left:right]
+        track.template = template.copy() if template.size > 0 else None
+
+    def merge(self, frame, face_locations, timestamp, regions=None, shift=0.0):
+        """
+        Merge in the faces found by a full scan of `frame`, taken at `timestamp`.
+        The scan may have run in the background while tracking carried on, so
+        faces that overlap an existing track are taken to be that track and
+        leave it untouched, and only new faces start new tracks. Tracks the scan
+        didn't find that have also lost their face are dropped, if the scan
+        covered them: pass the scanned `regions` for scans of part of the frame.
+        `shift` is how far the camera's panning has moved things along x since
+        `frame`, as from `world_frame.CameraPanModel.image_shift`.
+
+        Returns:
+            list: The track ID for each face.
+        """
+        # Kept to itself: `self.gray` is the latest tracked frame, which the
+        # detect stage may still be cutting templates from, and `frame` is older
+        gray = self._grayscale(frame)
+        unmatched = list(self.tracks)
+        track_ids = []
+        for face_location in face_locations:
+            top, right, bottom, left = face_location
+            shifted_location = (top, right + shift, bottom, left + shift)
+            best = max(unmatched, key=lambda t: box_iou(t.face_location, shifted_location), default=None)
+            if best is not None and box_iou(best.face_location, shifted_location) > 0.3:
+                unmatched.remove(best)
+                track_ids.append(best.id)
+                continue
+            track = Track(self.next_id, face_location, "Unknown", timestamp)
+            self.next_id += 1
+            # The template comes from where the face is in `frame`, then the
+            # track moves to where the face is now
+            self._take_template(track, gray)
+            track.state[0] += shift
+            self.tracks.append(track)
+            track_ids.append(track.id)
+
+        def scanned(track):
+            if regions is None:
+                return True
+            center_x, center_y = track.state[0] - shift, track.state[1]
+            return any(left <= center_x < right and top <= center_y < bottom for (top, right, bottom, left) in regions)
+
+        self.tracks = [track for track in self.tracks if track.live or track not in unmatched or not scanned(track)]
+        return track_ids
+
+    def update(self, frame, timestamp):
+        """
+        Move every track to where it is predicted to be in `frame` and refine the
+        position by correlation. Tracks that have moved out of the frame are
+        dropped.
+
+        Returns:
+            list: The tracks that need the detector to confirm them.
+        """
+        self._prepare(frame)
+        self.timestamp = timestamp
+        for track in self.tracks:
+            track.predict(timestamp)
+        self.tracks = [track for track in self.tracks if track.in_frame()]
+        to_redetect = []
+        for track in self.tracks:
+            track.frames_since_detection += 1
+            track.confidence = self._correlate(track)
+            track.live = track.confidence >= self.redetect_threshold
+            if not track.live or track.frames_since_detection >= self.redetect_interval:
+                to_redetect.append(track)
+        return to_redetect
+
+    def _correlate(self, track):
+        if track.template is None:
+            return 0.0
+        top, right, bottom, left = self._pixels(track.face_location, margin=0.5)
+        window = self.gray[top:bottom, left:right]
+        template_height, template_width = track.template.shape
+        if window.shape[0] < template_height or window.shape[1] < template_width or template_width < 4 or template_height < 4:
+            return 0.0
+
+        scores = cv2.matchTemplate(window, track.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (x, y) = cv2.minMaxLoc(scores)
+        if score >= self.redetect_threshold:
+            height, width = self.gray.shape
+            center = ((left + x + template_width / 2) / width, (top + y + template_height / 2) / height)
+            track.correct(center, CORRELATION_NOISE)
+        return float(score)
+
+    def pan(self, shift_x):
+        """
+        Move every track by `shift_x` normalized units along x, for when the
+        camera has panned between frames, so the motion model only has to
+        follow the faces' own movement.
+        """
+        for track in self.tracks:
+            track.state[0] += shift_x
+
+    def correct(self, track, face_location):
+        """
+        Apply a detector result to a track and refresh its template.
+        """
+        top, right, bottom, left = face_location
+        track.width = right - left
+        track.height = bottom - top
+        track.correct(((left + right) / 2, (top + bottom) / 2), DETECTION_NOISE)
+        track.live = True
+        track.confidence = 1.0
+        track.frames_since_detection = 0
+        track.misses = 0
+        self._take_template(track)
+
+    def miss(self, track):
+        """
+        Record that the detector could not find a track's face. The track stays
+        where it was last seen until the next full scan, rather than carrying on
+        at its last velocity, and is dropped after `max_misses` misses in a row
+        or once it is out of the frame.
+        """
+        track.live = False
+        track.frames_since_detection = 0
+        track.misses += 1
+        track.state[2:] = 0.0
+        if track.misses >= self.max_misses or not track.in_frame():
+            self.tracks = [other for other in self.tracks if other is not track]
+
+    def set_names(self, names_by_id):
+        for track in self.tracks:
+            if track.id in names_by_id:
+                track.name = names_by_id[track.id]
+
+    def face_locations(self):
+        return [track.face_location for track in self.tracks]
+
+    def face_names(self):
+        return [track.name for track in self.tracks]
+
+    def velocities(self):
+        """
+        The (x, y) velocity of each face, in normalized units per second.
+        """
+        return [(float(track.state[2]), float(track.state[3])) for track in self.tracks]
+
+    def live(self):
+        return [track.live for track in self.tracks]
+
+    def ids(self):
+        return [track.id for track in self.tracks]
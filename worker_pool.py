@@ -0,0 +1,231 @@
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from metrics import metrics
+
+# How far each strip of a whole frame scan reaches into its neighbours, in
+# normalized units, so that a face on a border is seen whole by one strip
+STRIP_OVERLAP = 0.1
+
+
+class SharedFrame:
+    """
+    A block of shared memory that frames are copied into, so worker processes
+    can read them in place instead of having them pickled to them. The block
+    grows when a bigger frame comes along.
+    """
+
+    def __init__(self):
+        self.shm = None
+
+    def write(self, frame):
+        """
+        Copy `frame` into shared memory and return the descriptor a worker
+        opens it with.
+        """
+        frame = np.ascontiguousarray(frame)
+        if self.shm is None or self.shm.size < frame.nbytes:
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(frame.nbytes, 1))
+        np.ndarray(frame.shape, frame.dtype, buffer=self.shm.buf)[...] = frame
+        return (self.shm.name, frame.shape, frame.dtype.str)
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+# Shared memory blocks the worker has opened, by name
+_attached = {}
+
+
+def _open_frame(descriptor):
+    name, shape, dtype = descriptor
+    shm = _attached.get(name)
+    if shm is None:
+        if len(_attached) >= 16:
+            # Blocks are replaced when frames grow, so let go of old ones
+            for old in _attached.values():
+                old.close()
+            _attached.clear()
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+
+def _init_worker(full_detector, delta_detector):
+    import find_faces
+
+    find_faces.set_detectors(full=full_detector, delta=delta_detector)
+    find_faces.warm_up()
+
+
+def _delta_scan_task(descriptor, face_locations, face_names, live, crop_settings):
+    import find_faces
+
+    return find_faces.delta_scan(_open_frame(descriptor), face_locations, face_names, live, **crop_settings)
+
+
+def _locate_task(descriptor, regions):
+    import find_faces
+
+    _, face_locations, timings = find_faces.locate_faces_in_regions(_open_frame(descriptor), regions)
+    return face_locations, timings
+
+
+def _identify_task(descriptor, face_locations):
+    import find_faces
+
+    face_encodings, matches, timings = find_faces.identify_faces(_open_frame(descriptor), face_locations)
+    return [np.asarray(encoding) for encoding in face_encodings], matches, timings
+
+
+def split(items, parts):
+    """
+    Split a list into at most `parts` contiguous, non-empty chunks, returned
+    with the index of their first item.
+    """
+    bounds = np.linspace(0, len(items), min(parts, len(items)) + 1).astype(int)
+    return [(int(start), items[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+class WorkerPool:
+    """
+    Worker processes that each own their own detectors, face encoder and
+    matcher, so that detection and encoding run on all cores rather than one
+    at a time under the GIL. The calls mirror those of `find_faces` and split
+    their work across the workers: delta scans by tracked face, full scans by
+    region and encoding by face. Frames reach the workers through shared
+    memory. Calls may be made from several threads at once.
+
+    Args:
+        workers (int): Number of worker processes.
+        full_detector (str): Detector backend for full scans.
+        delta_detector (str): Detector backend for delta scans.
+        slots (int): Frames that can be in flight at once.
+    """
+
+    def __init__(self, workers=4, full_detector="mtcnn", delta_detector="mtcnn", slots=4):
+        self.workers = workers
+        self.full_detector = full_detector
+        self.delta_detector = delta_detector
+        self.slots = queue.Queue()
+        self._all_slots = [SharedFrame() for _ in range(slots)]
+        for slot in self._all_slots:
+            self.slots.put(slot)
+        self.executor = None
+
+    def start(self):
+        # Spawned rather than forked, as forking a process with running
+        # threads and TensorFlow loaded isn't safe
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.full_detector, self.delta_detector))
+        # Make every worker start, and load its models, now rather than on the first frame
+        for future in [self.executor.submit(int) for _ in range(self.workers)]:
+            future.result()
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        for slot in self._all_slots:
+            slot.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self, frame, task, chunks):
+        slot = self.slots.get()
+        try:
+            descriptor = slot.write(frame)
+            futures = [self.executor.submit(task, descriptor, *chunk) for chunk in chunks]
+            return [future.result() for future in futures]
+        finally:
+            self.slots.put(slot)
+
+    def delta_scan(self, frame, previous_face_locations, previous_face_names, previous_live, **crop_settings):
+        """
+        `find_faces.delta_scan`, with the tracked faces split across the workers.
+        """
+        face_locations, face_names, live = [], [], []
+        timings = {'face_location': 0.0, 'face_encoding': 0.0, 'face_matching': 0.0}
+        if not previous_face_locations:
+            return face_locations, face_names, live, timings
+
+        with metrics.timer("pool.delta_scan") as timer:
+            chunks = [
+                (locations, previous_face_names[start:start + len(locations)], previous_live[start:start + len(locations)],
+                 crop_settings)
+                for start, locations in split(list(previous_face_locations), self.workers)
+            ]
+            for chunk_locations, chunk_names, chunk_live, _ in self._run(frame, _delta_scan_task, chunks):
+                face_locations += chunk_locations
+                face_names += chunk_names
+                live += chunk_live
+        timings['face_location'] = timer.ms
+        metrics.count("delta_scan.failed", live.count(False))
+        return face_locations, face_names, live, timings
+
+    def locate_faces_in_regions(self, frame, regions):
+        """
+        `find_faces.locate_faces_in_regions`, with the regions split across the workers,
+        or `locate_faces` when that is cheaper.
+        """
+        from find_faces import tiled_scan_worthwhile
+
+        if not tiled_scan_worthwhile(frame, regions):
+            # Decided here for all the regions, rather than by each worker for its share
+            return self.locate_faces(frame)
+        return self._locate_regions(frame, regions)
+
+    def _locate_regions(self, frame, regions):
+        from find_faces import non_max_suppression
+
+        face_locations = []
+        with metrics.timer("pool.full_scan") as timer:
+            chunks = [(chunk,) for _, chunk in split(list(regions), self.workers)]
+            for chunk_face_locations, _ in self._run(frame, _locate_task, chunks):
+                face_locations += chunk_face_locations
+        rgb_frame = frame[:, :, 2::-1]
+        return rgb_frame, non_max_suppression(face_locations), {'face_location': timer.ms}
+
+    def locate_faces(self, frame):
+        """
+        Find the faces in the whole of a frame that is already at detection
+        resolution, like `find_faces.locate_faces(frame, scale=1.0)`, with
+        each worker scanning an overlapping vertical strip.
+        """
+        width = 1 / self.workers
+        regions = [
+            (0.0, min(1.0, (i + 1) * width + STRIP_OVERLAP), 1.0, max(0.0, i * width - STRIP_OVERLAP))
+            for i in range(self.workers)
+        ]
+        return self._locate_regions(frame, regions)
+
+    def identify_faces(self, rgb_frame, face_locations):
+        """
+        `find_faces.identify_faces`, with the faces split across the workers.
+        """
+        face_encodings, matches = [], []
+        timings = {'face_encoding': 0.0, 'face_matching': 0.0}
+        if not face_locations:
+            return face_encodings, matches, timings
+
+        chunks = [(chunk,) for _, chunk in split(list(face_locations), self.workers)]
+        with metrics.timer("pool.identify") as timer:
+            for chunk_encodings, chunk_matches, chunk_timings in self._run(rgb_frame, _identify_task, chunks):
+                face_encodings += chunk_encodings
+                matches += chunk_matches
+                timings['face_matching'] = max(timings['face_matching'], chunk_timings['face_matching'])
+        timings['face_encoding'] = timer.ms - timings['face_matching']
+        return face_encodings, matches, timings
@@ -0,0 +1,64 @@
+# Horizontal field of view of the Raspberry Pi Camera Module 2, in degrees.
+# The Camera Module 3 is 66 degrees.
+CAMERA_FIELD_OF_VIEW = 62.2
+
+# Whether increasing the servo angle pans the camera towards the right (1) or
+# the left (-1) of the (flipped) image
+PAN_DIRECTION = 1
+
+# Servo angle assumed before the servo has been moved
+CENTER_ANGLE = 90.0
+
+
+class CameraPanModel:
+    """
+    Relates positions in the image to pan angles in the world, from the angle
+    the servo was at when each frame was captured and the camera's field of
+    view. This lets the servo be aimed at where a face is in the world rather
+    than where it is in the image, and lets the tracker tell the camera's own
+    panning apart from the faces' movement.
+
+    This only holds when the servo really turns the camera. For a replayed
+    recording, or a simulated servo, pass `camera_moves=False`: the camera is
+    then taken to stay at `CENTER_ANGLE`, so nothing is shifted.
+
+    Args:
+        servo (ServoController): The servo whose angle history is used.
+        field_of_view (float): Horizontal field of view of the camera, in degrees.
+        direction (int): `PAN_DIRECTION` of the stand.
+        camera_moves (bool): Whether the servo turns the camera the frames come from.
+    """
+
+    def __init__(self, servo, field_of_view=CAMERA_FIELD_OF_VIEW, direction=PAN_DIRECTION, camera_moves=True):
+        self.servo = servo
+        self.field_of_view = field_of_view
+        self.direction = direction
+        self.camera_moves = camera_moves
+
+    def camera_angle(self, timestamp):
+        if not self.camera_moves:
+            return CENTER_ANGLE
+        angle = self.servo.angle_at(timestamp)
+        return CENTER_ANGLE if angle is None else angle
+
+    def image_to_pan(self, x, timestamp):
+        """
+        The pan angle of the normalized image x position `x` in the frame
+        captured at `timestamp`.
+        """
+        return self.camera_angle(timestamp) + self.direction * (x - 0.5) * self.field_of_view
+
+    def pan_velocity(self, velocity_x):
+        """
+        Convert a velocity in normalized image units per second to degrees per second.
+        """
+        return self.direction * velocity_x * self.field_of_view
+
+    def image_shift(self, from_time, to_time):
+        """
+        How far, in normalized image units, a still object moves along x
+        between the frames captured at `from_time` and `to_time` because the
+        camera panned.
+        """
+        panned = self.camera_angle(to_time) - self.camera_angle(from_time)
+        return -self.direction * panned / self.field_of_view